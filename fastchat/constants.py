@@ -1,4 +1,8 @@
 CONTROLLER_HEART_BEAT_EXPIRATION = 2 * 60
 WORKER_HEART_BEAT_INTERVAL = 1
+WORKER_DISCONNECT_POLL_INTERVAL = 0.1
+WORKER_CONNECT_TIMEOUT = 5
+WORKER_FIRST_BYTE_TIMEOUT = 120
+WORKER_IDLE_TIMEOUT = 60
 
 LOGDIR = "."
@@ -0,0 +1,34 @@
+"""
+Deploy a quantized model once and save the result, so that model workers
+load the deployed model instead of repeating the deployment at startup.
+
+Usage:
+python3 -m fastchat.serve.compile_model --model-file quantized_opt-1.3b.pth
+"""
+import argparse
+import os
+
+import torch
+
+from fastchat.serve.model_worker import deploy_model, deployed_model_file
+
+
+def compile_model(model_file):
+    model = deploy_model(model_file)
+    deployed_file = deployed_model_file(model_file)
+    print(f"Save deployed model {deployed_file}...")
+    try:
+        torch.save(model, deployed_file + ".tmp")
+    except BaseException:
+        if os.path.exists(deployed_file + ".tmp"):
+            os.remove(deployed_file + ".tmp")
+        raise
+    os.replace(deployed_file + ".tmp", deployed_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-file", type=str, required=True)
+    args = parser.parse_args()
+
+    compile_model(args.model_file)
@@ -4,30 +4,91 @@ It sends worker addresses to clients.
 """
 import argparse
 import asyncio
+import bisect
+import collections
 import dataclasses
 from enum import Enum, auto
+import hashlib
 import json
 import logging
+import math
+import random
 import time
 from typing import List, Union
 import threading
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
+import aiohttp
 import numpy as np
 import requests
 import uvicorn
 
-from fastchat.constants import CONTROLLER_HEART_BEAT_EXPIRATION
+from fastchat.constants import (CONTROLLER_HEART_BEAT_EXPIRATION,
+    WORKER_CONNECT_TIMEOUT, WORKER_FIRST_BYTE_TIMEOUT, WORKER_IDLE_TIMEOUT)
+from fastchat.conversation import conv_templates
 from fastchat.utils import build_logger, server_error_msg
 
 
 logger = build_logger("controller", "controller.log")
 
+# The weight of a new sample in the speed estimates of the workers.
+SPEED_EWMA_ALPHA = 0.2
+
+# Above this many workers of a model, LEAST_OUTSTANDING compares two random
+# workers instead of all of them.
+POWER_OF_TWO_MIN_WORKERS = 8
+
+# AFFINITY places every worker at this many points of a hash ring, sends a
+# request to the first worker after its key on the ring, and skips workers
+# whose outstanding requests would exceed this factor of their fair share.
+AFFINITY_VIRTUAL_NODES = 64
+AFFINITY_LOAD_FACTOR = 1.25
+# Requests without a session id are keyed by the first user turn of their
+# prompt, after the fixed system prompt and examples that every conversation
+# of its template shares, or by this many leading characters of the prompt.
+AFFINITY_PREFIX_CHARS = 512
+# (preamble, separator) of every template, longest preamble first.
+TEMPLATE_PREAMBLES = sorted({(conv.get_prompt(), conv.sep) for conv in conv_templates.values()},
+                            key=lambda x: len(x[0]), reverse=True)
+
+
+# Prompts are not tokenized in the controller; OPT's tokenizer averages about
+# four bytes of English text per token.
+BYTES_PER_TOKEN = 4
+
+
+def estimate_cost(params: dict):
+    """The tokens a request prefills and generates at most, estimated."""
+    prompt_tokens = len(params.get("prompt", "").encode()) // BYTES_PER_TOKEN + 1
+    # Workers cap max_new_tokens at 1024.
+    return prompt_tokens + min(int(params.get("max_new_tokens", 256)), 1024)
+
+
+def hash_key(key: str):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def affinity_key(params: dict):
+    """The key that keeps the turns of a conversation on one worker, or None."""
+    if params.get("session_id"):
+        return "session:" + str(params["session_id"])
+    prompt = params.get("prompt")
+    if prompt:
+        for preamble, sep in TEMPLATE_PREAMBLES:
+            if prompt.startswith(preamble):
+                prompt = prompt[len(preamble):].split(sep, 1)[0]
+                break
+        return "prompt:" + prompt[:AFFINITY_PREFIX_CHARS]
+    return None
+
 
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    LEAST_OUTSTANDING = auto()
+    AFFINITY = auto()
+    LEAST_WORK = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -35,6 +96,12 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "least_outstanding":
+            return cls.LEAST_OUTSTANDING
+        elif name == "affinity":
+            return cls.AFFINITY
+        elif name == "least_work":
+            return cls.LEAST_WORK
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -46,6 +113,89 @@ class WorkerInfo:
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
+    num_running: int = 0
+    num_waiting: int = 0
+    pending_tokens: int = 0
+    decode_tokens_per_s: float = 0.0
+    capacity: int = 1
+
+
+@dataclasses.dataclass
+class SpeedEstimate:
+    """
+    Exponentially weighted moving averages of the latency of a worker,
+    measured on the streams the controller proxies to it.
+    """
+    ttft: float = 0.0
+    decode_tokens_per_s: float = 0.0
+    num_tokens: float = 0.0
+    num_samples: int = 0
+
+    def update(self, ttft: float, decode_tokens_per_s: float, num_tokens: int):
+        if self.num_samples == 0:
+            self.ttft = ttft
+            self.decode_tokens_per_s = decode_tokens_per_s
+            self.num_tokens = num_tokens
+        else:
+            a = SPEED_EWMA_ALPHA
+            self.ttft += a * (ttft - self.ttft)
+            self.decode_tokens_per_s += a * (decode_tokens_per_s - self.decode_tokens_per_s)
+            self.num_tokens += a * (num_tokens - self.num_tokens)
+        self.num_samples += 1
+
+    def speed(self):
+        """Requests per second: the inverse of the expected stream duration."""
+        return 1.0 / (self.ttft + self.num_tokens / max(self.decode_tokens_per_s, 1e-3))
+
+
+class StreamMeter:
+    """
+    Find the first and the last message of a proxied stream and when they
+    arrived, without parsing the messages in between.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.head = b""
+        self.first = None
+        self.first_time = None
+        self.tail = b""
+        self.last_time = None
+
+    def feed(self, chunk: bytes):
+        now = time.time()
+        if self.first is None:
+            self.head += chunk
+            end = self.head.find(b"\0")
+            if end >= 0:
+                self.first = self.head[:end]
+                self.first_time = now
+                self.head = b""
+        # Keep the bytes after the second to last separator.
+        self.tail += chunk
+        cut = self.tail.rfind(b"\0", 0, len(self.tail) - 1)
+        if cut >= 0:
+            self.tail = self.tail[cut + 1:]
+        self.last_time = now
+
+    def sample(self):
+        """(ttft, decode_tokens_per_s, num_tokens) of the stream, or None."""
+        if self.first is None or not self.tail.endswith(b"\0"):
+            return None
+        first = json.loads(self.first)
+        last = json.loads(self.tail[:-1])
+        # Streams replayed from a cache carry no token counts.
+        if last.get("error_code") != 0 or "num_tokens" not in first or "num_tokens" not in last:
+            return None
+        num_decoded = last["num_tokens"] - first["num_tokens"]
+        elapsed = self.last_time - self.first_time
+        if num_decoded <= 0 or elapsed <= 0:
+            return None
+        return self.first_time - self.start, num_decoded / elapsed, last["num_tokens"]
+
+
+# Optional load fields that workers report in their status and heart beats.
+LOAD_FIELDS = ["num_running", "num_waiting", "pending_tokens", "decode_tokens_per_s"]
 
 
 def heart_beat_controller(controller):
@@ -59,6 +209,17 @@ class Controller:
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
+        self.session = None
+        # Dict[str -> int], the requests proxied to every worker that have
+        # not finished yet.
+        self.num_in_flight = collections.Counter()
+        # Dict[str -> int], the estimated tokens of those requests.
+        self.pending_work = collections.Counter()
+        # Dict[str -> SpeedEstimate]
+        self.speed_estimates = collections.defaultdict(SpeedEstimate)
+        # The hash ring of AFFINITY and the workers it was built for.
+        self.ring_workers = None
+        self.ring = []
 
         self.heart_beat_thread = threading.Thread(
             target=heart_beat_controller, args=(self,))
@@ -81,6 +242,8 @@ class Controller:
         self.worker_info[worker_name] = WorkerInfo(
             worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
             check_heart_beat, time.time())
+        self.worker_info[worker_name].capacity = worker_status.get("capacity", 1)
+        self.update_load(worker_name, worker_status)
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
@@ -100,6 +263,7 @@ class Controller:
 
     def remove_worker(self, worker_name: str):
         del self.worker_info[worker_name]
+        self.speed_estimates.pop(worker_name, None)
 
     def refresh_all_workers(self):
         old_info = dict(self.worker_info)
@@ -117,14 +281,14 @@ class Controller:
 
         return list(model_names)
 
-    def get_worker_address(self, model_name: str):
+    def get_worker_address(self, model_name: str, affinity_key: str = None, cost: int = 0):
         if self.dispatch_method == DispatchMethod.LOTTERY:
             worker_names = []
             worker_speeds = []
             for w_name, w_info in self.worker_info.items():
                 if model_name in w_info.model_names:
                     worker_names.append(w_name)
-                    worker_speeds.append(w_info.speed)
+                    worker_speeds.append(self.worker_speed(w_name))
             worker_speeds = np.array(worker_speeds, dtype=np.float32)
             norm = np.sum(worker_speeds)
             if norm < 1e-4:
@@ -159,7 +323,7 @@ class Controller:
             for w_name, w_info in self.worker_info.items():
                 if model_name in w_info.model_names:
                     worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
+                    worker_qlen.append(w_info.queue_length / self.worker_speed(w_name))
             if len(worker_names) == 0:
                 return ""
             min_index = np.argmin(worker_qlen)
@@ -167,16 +331,177 @@ class Controller:
             self.worker_info[w_name].queue_length += 1
             logger.info(f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}")
             return w_name
+        elif self.dispatch_method == DispatchMethod.LEAST_OUTSTANDING:
+            worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                            if model_name in w_info.model_names]
+            if len(worker_names) == 0:
+                return ""
+            if len(worker_names) > POWER_OF_TWO_MIN_WORKERS:
+                # The less loaded of two random workers is nearly as good as
+                # the least loaded of all, without scanning the whole pool.
+                worker_names = random.sample(worker_names, 2)
+            else:
+                random.shuffle(worker_names)
+            w_name = min(worker_names, key=self.outstanding_load)
+            logger.info(f"names: {worker_names}, "
+                        f"loads: {[self.outstanding_load(w) for w in worker_names]}, ret: {w_name}")
+            # Clients that only ask for an address are not in num_in_flight;
+            # count them until the next heart beat.
+            self.worker_info[w_name].queue_length += 1
+            return w_name
+        elif self.dispatch_method == DispatchMethod.AFFINITY:
+            worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                            if model_name in w_info.model_names]
+            if len(worker_names) == 0:
+                return ""
+            w_name = None
+            if affinity_key is not None:
+                w_name = self.affinity_worker(worker_names, affinity_key)
+            if w_name is None:
+                w_name = min(worker_names, key=self.outstanding_load)
+            logger.info(f"names: {worker_names}, ret: {w_name}")
+            # Clients that only ask for an address are not in num_in_flight;
+            # count them until the next heart beat.
+            self.worker_info[w_name].queue_length += 1
+            return w_name
+        elif self.dispatch_method == DispatchMethod.LEAST_WORK:
+            worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                            if model_name in w_info.model_names]
+            if len(worker_names) == 0:
+                return ""
+            random.shuffle(worker_names)
+            times = [self.completion_time(w_name, cost) for w_name in worker_names]
+            w_name = worker_names[int(np.argmin(times))]
+            logger.info(f"names: {worker_names}, times: {times}, ret: {w_name}")
+            # Count the work of clients that stream from the worker directly
+            # until the next heart beat.
+            self.worker_info[w_name].pending_tokens += cost
+            return w_name
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    def worker_speed(self, worker_name: str):
+        """
+        The measured speed of a worker. Until a worker has been measured,
+        it gets the average speed of the measured workers, or the speed it
+        reports if none is measured yet.
+        """
+        estimate = self.speed_estimates.get(worker_name)
+        if estimate is not None:
+            return estimate.speed()
+        if self.speed_estimates:
+            speeds = [e.speed() for e in self.speed_estimates.values()]
+            return sum(speeds) / len(speeds)
+        return self.worker_info[worker_name].speed
+
+    def get_worker_speeds(self):
+        return {
+            w_name: {**dataclasses.asdict(estimate), "speed": estimate.speed()}
+            for w_name, estimate in self.speed_estimates.items()
+        }
+
+    def hash_ring(self):
+        """[(hash, worker name)] of all workers, sorted by hash."""
+        workers = tuple(sorted(self.worker_info))
+        if workers != self.ring_workers:
+            self.ring = sorted((hash_key(f"{w_name}#{i}"), w_name)
+                               for w_name in workers for i in range(AFFINITY_VIRTUAL_NODES))
+            self.ring_workers = workers
+        return self.ring
+
+    def affinity_worker(self, worker_names: list, key: str):
+        """
+        The first worker of `worker_names` after `key` on the hash ring that
+        has room for one more request within its bounded share of the load,
+        or None if all of them are full.
+        """
+        outstanding = {w_name: max(self.num_in_flight[w_name], self.worker_info[w_name].queue_length)
+                       for w_name in worker_names}
+        capacity = {w_name: max(self.worker_info[w_name].capacity, 1) for w_name in worker_names}
+        total = sum(outstanding.values()) + 1
+        total_capacity = sum(capacity.values())
+
+        ring = self.hash_ring()
+        start = bisect.bisect(ring, (hash_key(key), ""))
+        seen = set()
+        for i in range(len(ring)):
+            w_name = ring[(start + i) % len(ring)][1]
+            if w_name not in outstanding or w_name in seen:
+                continue
+            seen.add(w_name)
+            limit = math.ceil(AFFINITY_LOAD_FACTOR * total * capacity[w_name] / total_capacity)
+            if outstanding[w_name] + 1 <= limit:
+                return w_name
+            if len(seen) == len(outstanding):
+                break
+        return None
+
+    def outstanding_load(self, worker_name: str):
+        """
+        The requests outstanding on a worker per request it can run at once.
+        The requests in flight through the proxy are counted exactly; the
+        queue length of the last heart beat, plus the addresses handed out
+        since, also covers the requests that clients sent to the worker
+        directly.
+        """
+        w_info = self.worker_info[worker_name]
+        outstanding = max(self.num_in_flight[worker_name], w_info.queue_length)
+        return outstanding / max(w_info.capacity, 1)
+
+    def worker_throughput(self, worker_name: str):
+        """
+        The tokens per second a worker generates over a full batch, from the
+        measured decoding speed of its streams and its capacity.
+        """
+        estimate = self.speed_estimates.get(worker_name)
+        if estimate is not None:
+            rate = estimate.decode_tokens_per_s
+        elif self.speed_estimates:
+            rates = [e.decode_tokens_per_s for e in self.speed_estimates.values()]
+            rate = sum(rates) / len(rates)
+        else:
+            rate = 1.0
+        return max(rate, 1e-3) * max(self.worker_info[worker_name].capacity, 1)
+
+    def completion_time(self, worker_name: str, cost: int):
+        """
+        The expected time until a worker has done its pending work and a
+        new request of `cost` tokens. The work proxied through the controller
+        is known exactly; the pending tokens of the last heart beat, plus the
+        cost of the requests dispatched since, also cover the requests that
+        clients sent to the worker directly.
+        """
+        pending = max(self.pending_work[worker_name],
+                      self.worker_info[worker_name].pending_tokens)
+        return (pending + cost) / self.worker_throughput(worker_name)
+
+    def begin_requests(self, worker_name: str, n: int = 1, work: int = 0):
+        self.num_in_flight[worker_name] += n
+        self.pending_work[worker_name] += work
+
+    def end_requests(self, worker_name: str, n: int = 1, work: int = 0):
+        self.num_in_flight[worker_name] -= n
+        if self.num_in_flight[worker_name] <= 0:
+            del self.num_in_flight[worker_name]
+        self.pending_work[worker_name] -= work
+        if self.pending_work[worker_name] <= 0:
+            del self.pending_work[worker_name]
+
+    def update_load(self, worker_name: str, load: dict):
+        w_info = self.worker_info[worker_name]
+        for field in LOAD_FIELDS:
+            if field in load:
+                setattr(w_info, field, load[field])
+
+    def receive_heart_beat(self, worker_name: str, queue_length: int,
+                           load: dict = None):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
         self.worker_info[worker_name].queue_length = queue_length
         self.worker_info[worker_name].last_heart_beat = time.time()
+        self.update_load(worker_name, load or {})
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
@@ -190,8 +515,44 @@ class Controller:
         for worker_name in to_delete:
             self.remove_worker(worker_name)
 
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+    def get_session(self):
+        """
+        The HTTP session of the proxy. Its connector keeps a pool of
+        keep-alive connections to every worker, with no limit on their
+        number.
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0))
+        return self.session
+
+    async def close_session(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def proxy_stream(self, url, params):
+        """
+        Yield the body of the streaming response of `url` as it arrives.
+        The worker has WORKER_FIRST_BYTE_TIMEOUT seconds to start answering
+        and WORKER_IDLE_TIMEOUT seconds between two chunks after that.
+        """
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=WORKER_CONNECT_TIMEOUT,
+                                        sock_read=WORKER_FIRST_BYTE_TIMEOUT)
+        # Leaving the block early closes the connection instead of returning
+        # it to the pool, which makes the worker abort the request.
+        async with self.get_session().post(url, json=params, timeout=timeout) as response:
+            response.raise_for_status()
+            read_timeout = WORKER_FIRST_BYTE_TIMEOUT
+            while True:
+                chunk = await asyncio.wait_for(response.content.readany(), read_timeout)
+                if not chunk:
+                    break
+                yield chunk
+                read_timeout = WORKER_IDLE_TIMEOUT
+
+    async def worker_api_generate_stream(self, params):
+        cost = estimate_cost(params)
+        worker_addr = self.get_worker_address(params["model"], affinity_key(params), cost)
         if not worker_addr:
             logger.info(f"no worker: {params['model']}")
             ret = {
@@ -199,21 +560,92 @@ class Controller:
                 "error_code": 2,
             }
             yield json.dumps(ret).encode() + b"\0"
+            return
 
+        # The chunks are passed on as they are, so they need not end at the
+        # end of a message.
+        at_boundary = True
+        meter = StreamMeter()
+        self.begin_requests(worker_addr, work=cost)
         try:
-            response = requests.post(worker_addr + "/worker_generate_stream",
-                json=params, stream=True, timeout=5)
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
+            async for chunk in self.proxy_stream(worker_addr + "/worker_generate_stream", params):
+                yield chunk
+                meter.feed(chunk)
+                at_boundary = chunk.endswith(b"\0")
+            sample = meter.sample()
+            if sample is not None:
+                self.speed_estimates[worker_addr].update(*sample)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.info(f"worker timeout: {worker_addr}")
-            ret = {
-                "text": server_error_msg,
-                "error_code": 3,
-            }
-            yield json.dumps(ret).encode() + b"\0"
-
+            if at_boundary:
+                ret = {
+                    "text": server_error_msg,
+                    "error_code": 3,
+                }
+                yield json.dumps(ret).encode() + b"\0"
+        finally:
+            self.end_requests(worker_addr, work=cost)
+
+    async def worker_api_generate_batch(self, params):
+        """
+        Shard a batch over all workers of the model and yield the JSON lines
+        of their /worker_generate_batch responses as they arrive, with the
+        indices mapped back to `params["prompts"]`.
+        """
+        prompts = params["prompts"]
+        worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                        if params["model"] in w_info.model_names]
+        if not worker_names:
+            logger.info(f"no worker: {params['model']}")
+            for i in range(len(prompts)):
+                ret = {"index": i, "text": server_error_msg, "error_code": 2}
+                yield json.dumps(ret).encode() + b"\n"
+            return
+
+        # Deal the prompts out by length so that every shard gets a similar
+        # amount of work.
+        costs = [estimate_cost(p) for p in prompts]
+        order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]["prompt"]))
+        shards = [order[k::len(worker_names)] for k in range(len(worker_names))]
+        results = asyncio.Queue()
+
+        async def run_shard(worker_addr, indices):
+            missing = set(indices)
+            buffer = b""
+            self.begin_requests(worker_addr, len(indices), sum(costs[i] for i in indices))
+            try:
+                async for chunk in self.proxy_stream(
+                        worker_addr + "/worker_generate_batch",
+                        {"model": params["model"], "prompts": [prompts[i] for i in indices]}):
+                    *lines, buffer = (buffer + chunk).split(b"\n")
+                    for line in lines:
+                        if line:
+                            ret = json.loads(line)
+                            ret["index"] = indices[ret["index"]]
+                            missing.discard(ret["index"])
+                            self.end_requests(worker_addr, work=costs[ret["index"]])
+                            results.put_nowait(ret)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.info(f"worker timeout: {worker_addr}")
+            finally:
+                self.end_requests(worker_addr, len(missing), sum(costs[i] for i in missing))
+                for i in sorted(missing):
+                    results.put_nowait({"index": i, "text": server_error_msg, "error_code": 3})
+                results.put_nowait(None)
+
+        tasks = [asyncio.create_task(run_shard(worker_addr, indices))
+                 for worker_addr, indices in zip(worker_names, shards)]
+        try:
+            num_running = len(tasks)
+            while num_running:
+                ret = await results.get()
+                if ret is None:
+                    num_running -= 1
+                else:
+                    yield json.dumps(ret).encode() + b"\n"
+        finally:
+            for task in tasks:
+                task.cancel()
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
@@ -221,6 +653,7 @@ class Controller:
         model_names = set()
         speed = 0
         queue_length = 0
+        load = dict.fromkeys(LOAD_FIELDS, 0)
 
         for w_name in self.worker_info:
             worker_status = self.get_worker_status(w_name)
@@ -228,11 +661,14 @@ class Controller:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
                 queue_length += worker_status["queue_length"]
+                for field in LOAD_FIELDS:
+                    load[field] += worker_status.get(field, 0)
 
         return {
             "model_names": list(model_names),
             "speed": speed,
             "queue_length": queue_length,
+            **load,
         }
 
 
@@ -261,7 +697,7 @@ async def list_models():
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
-    addr = controller.get_worker_address(data["model"])
+    addr = controller.get_worker_address(data["model"], affinity_key(data), estimate_cost(data))
     return {"address": addr}
 
 
@@ -269,7 +705,7 @@ async def get_worker_address(request: Request):
 async def receive_heart_beat(request: Request):
     data = await request.json()
     exist = controller.receive_heart_beat(
-        data["worker_name"], data["queue_length"])
+        data["worker_name"], data["queue_length"], data)
     return {"exist": exist}
 
 
@@ -280,16 +716,33 @@ async def worker_api_generate_stream(request: Request):
     return StreamingResponse(generator)
 
 
+@app.post("/worker_generate_batch")
+async def worker_api_generate_batch(request: Request):
+    params = await request.json()
+    generator = controller.worker_api_generate_batch(params)
+    return StreamingResponse(generator, media_type="application/x-ndjson")
+
+
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
     return controller.worker_api_get_status()
 
 
+@app.post("/get_worker_speeds")
+async def get_worker_speeds():
+    return controller.get_worker_speeds()
+
+
+@app.on_event("shutdown")
+async def close_session():
+    await controller.close_session()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="127.0.0.1")
     parser.add_argument("--port", type=int, default=21005)
-    parser.add_argument("--dispatch-method", type=str, choices=["lottery", "shortest_queue"], default="shortest_queue")
+    parser.add_argument("--dispatch-method", type=str, choices=["lottery", "shortest_queue", "least_outstanding", "affinity", "least_work"], default="shortest_queue")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -0,0 +1,73 @@
+"""
+Incremental detokenization for streaming generation.
+"""
+
+
+class IncrementalDetokenizer:
+    """
+    Turn a stream of token ids into a stream of text deltas.
+
+    Only the last few tokens are decoded at each step: `prefix_offset` marks
+    the start of a small window of context and `read_offset` the first token
+    whose text has not been returned yet. Decoding the window with and without
+    the unread tokens gives the new text without re-decoding the whole
+    output. While the window ends in an incomplete UTF-8 sequence (a byte-level
+    BPE token can hold part of a multi-byte character) nothing is returned.
+
+    The tokenizer's clean-up rules (" ." -> "." and friends) can span token
+    boundaries, so they run on the text stream instead, holding back a short
+    tail that may still turn into one of the patterns.
+    """
+
+    def __init__(self, tokenizer, prompt_ids=(), num_context_tokens=5,
+                 skip_special_tokens=True, clean_up_tokenization_spaces=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.clean_up_tokenization_spaces = clean_up_tokenization_spaces
+
+        # The tail of the prompt gives the first generated tokens the same
+        # context (e.g. leading spaces) as a full decode.
+        self.token_ids = list(prompt_ids[-num_context_tokens:])
+        self.prefix_offset = 0
+        self.read_offset = len(self.token_ids)
+        self.prefix_text = self.decode(self.token_ids)
+        self.pending = ""
+
+    def decode(self, token_ids):
+        return self.tokenizer.decode(
+            token_ids, skip_special_tokens=self.skip_special_tokens,
+            clean_up_tokenization_spaces=False)
+
+    def clean_up(self, text, final=False):
+        if not self.clean_up_tokenization_spaces:
+            return text
+        text = self.tokenizer.clean_up_tokenization(self.pending + text)
+        # Every clean-up pattern starts with a space and is at most four
+        # characters long, so only a space in the last three characters can
+        # still be the start of an incomplete one.
+        cut = -1 if final else text.find(" ", max(len(text) - 3, 0))
+        if cut == -1:
+            cut = len(text)
+        self.pending = text[cut:]
+        return text[:cut]
+
+    def push(self, token_id):
+        """Add a token id and return the text it completes (possibly "")."""
+        self.token_ids.append(token_id)
+        text = self.decode(self.token_ids[self.prefix_offset:])
+        if len(text) <= len(self.prefix_text) or text.endswith("\ufffd"):
+            return ""
+
+        delta = text[len(self.prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.prefix_text = self.decode(self.token_ids[self.prefix_offset:self.read_offset])
+        return self.clean_up(delta)
+
+    def flush(self):
+        """Return all pending text, even if it ends in a partial character."""
+        text = self.decode(self.token_ids[self.prefix_offset:])
+        delta = text[len(self.prefix_text):]
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        self.prefix_text = ""
+        return self.clean_up(delta, final=True)
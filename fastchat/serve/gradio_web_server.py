@@ -4,6 +4,7 @@ import datetime
 import json
 import os
 import time
+import uuid
 
 import gradio as gr
 import requests
@@ -145,7 +146,7 @@ def post_process_code(code):
     return code
 
 
-def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Request):
+def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request: gr.Request):
     start_tstamp = time.time()
     model_name = model_selector
     print("selected model: ", model_name)
@@ -163,17 +164,9 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
         new_state.append_message(new_state.roles[1], None)
         state = new_state
 
-    # Query worker address
-    controller_url = args.controller_url
-    ret = requests.post(controller_url + "/get_worker_address",
-            json={"model": model_name})
-    worker_addr = ret.json()["address"]
-
-    # No available worker
-    if worker_addr == "":
-        state.messages[-1][-1] = server_error_msg
-        yield (state, state.to_gradio_chatbot(), disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
-        return
+    # Lets an affinity controller keep the conversation on one worker.
+    if not hasattr(state, "session_id"):
+        state.session_id = uuid.uuid4().hex
 
     # Construct prompt
     prompt = state.get_prompt()
@@ -183,31 +176,51 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
         "model": model_name,
         "prompt": prompt,
         "temperature": float(temperature),
+        "top_p": float(top_p),
         "max_new_tokens": min(int(max_new_tokens), 1536),
         "stop": state.sep if state.sep_style == SeparatorStyle.SINGLE else state.sep2,
+        "delta": True,
+        "session_id": state.session_id,
     }
 
+    # Query worker address; the prompt and max_new_tokens let the
+    # controller weigh the cost of the request.
+    controller_url = args.controller_url
+    ret = requests.post(controller_url + "/get_worker_address",
+            json={key: pload[key] for key in ["model", "session_id", "prompt", "max_new_tokens"]})
+    worker_addr = ret.json()["address"]
+
+    # No available worker
+    if worker_addr == "":
+        state.messages[-1][-1] = server_error_msg
+        yield (state, state.to_gradio_chatbot(), disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
+        return
+
     state.messages[-1][-1] = "▌"
     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
 
     try:
         # Stream output
-        response = requests.post(worker_addr + "/worker_generate_stream",
-            headers=headers, json=pload, stream=True, timeout=10000)
-        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-            if chunk:
-                data = json.loads(chunk.decode())
-                if data["error_code"] == 0:
-                    output = data["text"][len(prompt) + 1:].strip()
-                    output = post_process_code(output)
-                    state.messages[-1][-1] = output + "▌"
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
-                else:
-                    output = data["text"] + f" (error_code: {data['error_code']})"
-                    state.messages[-1][-1] = output
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
-                    return
-                time.sleep(0.03)
+        # The worker aborts the request when the connection is closed, e.g.
+        # when Gradio drops this generator on regenerate or tab close.
+        with requests.post(worker_addr + "/worker_generate_stream",
+                headers=headers, json=pload, stream=True, timeout=10000) as response:
+            generated = ""
+            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+                if chunk:
+                    data = json.loads(chunk.decode())
+                    if data["error_code"] == 0:
+                        generated += data["text"]
+                        output = generated[1:].strip()
+                        output = post_process_code(output)
+                        state.messages[-1][-1] = output + "▌"
+                        yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
+                    else:
+                        output = data["text"] + f" (error_code: {data['error_code']})"
+                        state.messages[-1][-1] = output
+                        yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
+                        return
+                    time.sleep(0.03)
     except requests.exceptions.RequestException as e:
         state.messages[-1][-1] = server_error_msg
         yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
@@ -302,6 +315,7 @@ def build_demo():
 
         with gr.Accordion("Parameters", open=False, visible=False) as parameter_row:
             temperature = gr.Slider(minimum=0.0, maximum=1.0, value=0.7, step=0.1, interactive=True, label="Temperature",)
+            top_p = gr.Slider(minimum=0.1, maximum=1.0, value=1.0, step=0.1, interactive=True, label="Top P",)
             max_output_tokens = gr.Slider(minimum=0, maximum=256, value=128, step=32, interactive=True, label="Max output tokens",)
 
         gr.Markdown(license_markdown)
@@ -319,15 +333,15 @@ def build_demo():
             [state, model_selector], [textbox, upvote_btn, downvote_btn, flag_btn])
         regenerate_btn.click(regenerate, state,
             [state, chatbot, textbox] + btn_list).then(
-            http_bot, [state, model_selector, temperature, max_output_tokens],
+            http_bot, [state, model_selector, temperature, top_p, max_output_tokens],
             [state, chatbot] + btn_list)
         clear_btn.click(clear_history, None, [state, chatbot, textbox] + btn_list)
 
         textbox.submit(add_text, [state, textbox], [state, chatbot, textbox] + btn_list
-            ).then(http_bot, [state, model_selector, temperature, max_output_tokens],
+            ).then(http_bot, [state, model_selector, temperature, top_p, max_output_tokens],
                    [state, chatbot] + btn_list)
         submit_btn.click(add_text, [state, textbox], [state, chatbot, textbox] + btn_list
-            ).then(http_bot, [state, model_selector, temperature, max_output_tokens],
+            ).then(http_bot, [state, model_selector, temperature, top_p, max_output_tokens],
                    [state, chatbot] + btn_list)
 
         if args.model_list_mode == "once":
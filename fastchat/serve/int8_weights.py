@@ -0,0 +1,190 @@
+"""
+A memory-mapped file format for dynamically quantized int8 models.
+
+The file is a JSON header followed by the raw bytes of every tensor, each
+starting at a 64-byte aligned offset. Loading maps the file and wraps the
+tensors in place instead of unpickling them. The float parameters and
+buffers are faulted in on first use and stay in the page cache copy that
+workers on one host share. The int8 weights of the linear layers, the bulk
+of the file, and their biases are read in full at load time and repacked by
+`make_linear`, so every process holds its own copy of them.
+
+Usage:
+python3 -m fastchat.serve.int8_weights --model-file quantized_opt-1.3b.pth --output quantized_opt-1.3b.int8
+"""
+import argparse
+import json
+import mmap
+import struct
+
+import torch
+import transformers
+
+MAGIC = b"FCINT8\0\0"
+VERSION = 1
+ALIGNMENT = 64
+
+QUANTIZED_LINEAR = torch.ao.nn.quantized.dynamic.modules.linear.Linear
+
+
+def is_int8_file(path):
+    with open(path, "rb") as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class TensorWriter:
+    """Lay out tensors back to back at aligned offsets, storing each once."""
+
+    def __init__(self):
+        self.index = {}
+        self.tensors = []
+        self.size = 0
+        self.offsets = {}
+
+    def add(self, tensor):
+        tensor = tensor.detach()
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if key not in self.offsets:
+            tensor = tensor.cpu().contiguous()
+            self.size = align(self.size)
+            self.offsets[key] = self.size
+            self.tensors.append((self.size, tensor))
+            self.size += tensor.numel() * tensor.element_size()
+        return {
+            "dtype": str(tensor.dtype).split(".")[-1],
+            "shape": list(tensor.shape),
+            "offset": self.offsets[key],
+        }
+
+    def write(self, fout, start):
+        for offset, tensor in self.tensors:
+            fout.seek(start + offset)
+            if tensor.numel() > 0:
+                fout.write(tensor.reshape(-1).view(torch.uint8).numpy().data)
+
+
+def save_int8_model(model, path):
+    """Write `model`, whose linear layers are dynamically quantized, to `path`."""
+    writer = TensorWriter()
+    params = {name: writer.add(param)
+              for name, param in model.named_parameters(remove_duplicate=False)}
+    buffers = {name: writer.add(buf)
+               for name, buf in model.named_buffers(remove_duplicate=False)}
+
+    linears = {}
+    for name, module in model.named_modules():
+        if type(module) != QUANTIZED_LINEAR:
+            continue
+        weight, bias = module._packed_params._weight_bias()
+        layer = {
+            "in_features": module.in_features,
+            "out_features": module.out_features,
+            "weight": writer.add(torch.int_repr(weight)),
+            "bias": writer.add(bias) if bias is not None else None,
+        }
+        if weight.qscheme() == torch.per_tensor_affine:
+            layer["scale"] = weight.q_scale()
+            layer["zero_point"] = weight.q_zero_point()
+        else:
+            layer["scales"] = writer.add(weight.q_per_channel_scales())
+            layer["zero_points"] = writer.add(weight.q_per_channel_zero_points())
+            layer["axis"] = weight.q_per_channel_axis()
+        linears[name] = layer
+
+    header = json.dumps({
+        "version": VERSION,
+        "architecture": type(model).__name__,
+        "config": model.config.to_dict(),
+        "parameters": params,
+        "buffers": buffers,
+        "linears": linears,
+    }).encode()
+    start = align(len(MAGIC) + 8 + len(header))
+    with open(path, "wb") as fout:
+        fout.write(MAGIC)
+        fout.write(struct.pack("<Q", len(header)))
+        fout.write(header)
+        writer.write(fout, start)
+        fout.truncate(start + writer.size)
+
+
+def make_quantized_weight(weight, layer, tensor):
+    """A qint8 tensor from the int8 values and scales of `layer`."""
+    if "scale" in layer:
+        return torch._make_per_tensor_quantized_tensor(
+            weight, layer["scale"], layer["zero_point"])
+    return torch._make_per_channel_quantized_tensor(
+        weight, tensor(layer["scales"]), tensor(layer["zero_points"]), layer["axis"])
+
+
+def load_int8_model(path, make_linear):
+    """
+    Map the model saved at `path`. The float parameters and buffers point
+    into the mapping; `make_linear(in_features, out_features, weight_bias)`
+    builds the module for every quantized linear layer from its qint8 weight
+    and bias.
+    """
+    with open(path, "rb") as fin:
+        if fin.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an int8 weight file")
+        header_len, = struct.unpack("<Q", fin.read(8))
+        header = json.loads(fin.read(header_len))
+        if header["version"] != VERSION:
+            raise ValueError(f"unsupported int8 weight file version {header['version']}")
+        # A private mapping: clean pages stay shared with other processes.
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_COPY)
+    start = align(len(MAGIC) + 8 + header_len)
+
+    def tensor(entry):
+        dtype = getattr(torch, entry["dtype"])
+        count = 1
+        for dim in entry["shape"]:
+            count *= dim
+        if count == 0:
+            return torch.empty(entry["shape"], dtype=dtype)
+        return torch.frombuffer(buf, dtype=dtype, count=count,
+                                offset=start + entry["offset"]).view(entry["shape"])
+
+    model_class = getattr(transformers, header["architecture"])
+    config = model_class.config_class.from_dict(header["config"])
+    with torch.device("meta"):
+        model = model_class(config)
+
+    for name, layer in header["linears"].items():
+        weight = make_quantized_weight(tensor(layer["weight"]), layer, tensor)
+        bias = tensor(layer["bias"]) if layer["bias"] is not None else None
+        parent_name, _, attr = name.rpartition(".")
+        setattr(model.get_submodule(parent_name), attr,
+                make_linear(layer["in_features"], layer["out_features"], (weight, bias)))
+
+    # Tied parameters share their entry, so they stay tied.
+    shared = {}
+    for name, entry in header["parameters"].items():
+        key = entry["offset"], entry["dtype"], tuple(entry["shape"])
+        if key not in shared:
+            shared[key] = torch.nn.Parameter(tensor(entry), requires_grad=False)
+        module_name, _, attr = name.rpartition(".")
+        model.get_submodule(module_name)._parameters[attr] = shared[key]
+    for name, entry in header["buffers"].items():
+        module_name, _, attr = name.rpartition(".")
+        model.get_submodule(module_name)._buffers[attr] = tensor(entry)
+
+    missing = [name for name, t in list(model.named_parameters()) + list(model.named_buffers())
+               if t.is_meta]
+    if missing:
+        raise ValueError(f"{path} has no weights for {', '.join(missing)}")
+    model.eval()
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-file", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+
+    save_int8_model(torch.load(args.model_file), args.output)
@@ -0,0 +1,216 @@
+"""
+A preallocated key/value cache for batched OPT decoding.
+"""
+import types
+
+import torch
+
+
+class StaticKVCache:
+    """
+    Per-slot key/value buffers for every decoder layer, written in place.
+
+    Each running request owns one slot (a batch row) and stores its tokens
+    at positions [0, length) of that row. A forward pass over slots
+    [start, end) writes the new keys and values right after each row's
+    current length and attends over a view of the buffers, so no tensor is
+    concatenated or reallocated while the sequences grow.
+
+    The buffers are allocated with `torch.empty` and zeroed lazily up to the
+    longest view used so far, so the memory is only committed as the
+    sequences actually get long.
+    """
+
+    def __init__(self, num_layers, num_heads, head_dim, max_batch_size,
+                 max_len, dtype=torch.float32):
+        shape = (num_layers, max_batch_size, num_heads, max_len, head_dim)
+        self.keys = torch.empty(shape, dtype=dtype)
+        self.values = torch.empty(shape, dtype=dtype)
+        self.max_len = max_len
+        self.zeroed_len = 0
+
+        self.lengths = torch.zeros(max_batch_size, dtype=torch.long)
+        # OPT derives position ids from the 2D attention mask; row i has ones
+        # at its stored positions [0, lengths[i]). Views of it are passed to
+        # the model instead of building a new mask every step.
+        self.mask = torch.zeros(max_batch_size, max_len, dtype=torch.long)
+
+        self.layers = [StaticLayerCache(self, i) for i in range(num_layers)]
+        self.start = self.end = 0
+        self.past_len = self.num_new = 0
+        self.write_pos = None
+        self.bias = None
+
+    @classmethod
+    def for_model(cls, model, max_batch_size, max_len):
+        config = model.config
+        dtype = model.get_input_embeddings().weight.dtype
+        return cls(config.num_hidden_layers, config.num_attention_heads,
+                   config.hidden_size // config.num_attention_heads,
+                   max_batch_size, max_len, dtype)
+
+    @property
+    def num_bytes(self):
+        """The size of the buffers once every position has been used."""
+        return 2 * self.keys.numel() * self.keys.element_size()
+
+    def reset(self, slot):
+        self.lengths[slot] = 0
+        self.mask[slot] = 0
+
+    def ensure_zeroed(self, length):
+        if length > self.max_len:
+            raise ValueError(f"KV cache overflow: {length} > {self.max_len}")
+        if length > self.zeroed_len:
+            self.keys[:, :, :, self.zeroed_len:length] = 0
+            self.values[:, :, :, self.zeroed_len:length] = 0
+            self.zeroed_len = length
+
+    def load(self, slot, segments):
+        """Fill an empty slot with [layers, heads, len, head_dim] key/value
+        segments, e.g. a prefix found in a PrefixCache."""
+        length = sum(k.shape[2] for k, v in segments)
+        self.ensure_zeroed(length)
+        pos = 0
+        for k, v in segments:
+            n = k.shape[2]
+            self.keys[:, slot, :, pos:pos + n] = k
+            self.values[:, slot, :, pos:pos + n] = v
+            pos += n
+        self.lengths[slot] = length
+        self.mask[slot] = 0
+        self.mask[slot, :length] = 1
+
+    def slot_states(self, slot):
+        """Views of the [layers, heads, length, head_dim] keys and values of a slot."""
+        length = int(self.lengths[slot])
+        return self.keys[:, slot, :, :length], self.values[:, slot, :, :length]
+
+    def move(self, src, dst):
+        """Copy the cached tokens of slot `src` to slot `dst`."""
+        length = int(self.lengths[src])
+        self.keys[:, dst, :, :length] = self.keys[:, src, :, :length]
+        self.values[:, dst, :, :length] = self.values[:, src, :, :length]
+        self.lengths[dst] = length
+        self.mask[dst] = self.mask[src]
+
+    def truncate(self, start, lengths):
+        """Shorten the slots [start, start + len(lengths)) to `lengths`
+        tokens, e.g. to drop rejected speculative tokens."""
+        for slot, length in enumerate(lengths.tolist(), start):
+            self.mask[slot, length:] = 0
+            self.lengths[slot] = length
+
+    def begin(self, start, end, num_new):
+        """
+        Prepare a forward pass that appends `num_new` tokens to each of the
+        slots [start, end). Return the `past_key_values` and `attention_mask`
+        to pass to the model.
+        """
+        lengths = self.lengths[start:end]
+        self.start, self.end, self.num_new = start, end, num_new
+        self.past_len = int(lengths.max())
+        view_len = self.past_len + num_new
+        self.ensure_zeroed(view_len)
+
+        steps = torch.arange(num_new)
+        self.write_pos = lengths.unsqueeze(-1) + steps
+        # The new token j of row i sits at lengths[i] + j and may attend to
+        # every stored position up to and including its own.
+        cols = torch.arange(view_len)
+        allowed = cols <= self.write_pos.unsqueeze(-1)
+        self.bias = torch.zeros(allowed.shape, dtype=self.keys.dtype)
+        self.bias.masked_fill_(~allowed, torch.finfo(self.keys.dtype).min)
+        self.bias = self.bias.unsqueeze(1)
+
+        self.mask[start:end, self.past_len:view_len] = 1
+        return self.layers, self.mask[start:end, :view_len]
+
+    def commit(self):
+        """Account for the tokens written by the last forward pass."""
+        self.mask[self.start:self.end, self.past_len:self.past_len + self.num_new] = 0
+        self.lengths[self.start:self.end] += self.num_new
+        rows = torch.arange(self.start, self.end).unsqueeze(-1)
+        self.mask[rows, self.write_pos] = 1
+
+    def run(self, model, input_ids, start, end, num_logits=None):
+        """
+        Run `model` on `input_ids` [end - start, new] appended to the slots
+        [start, end) and return the logits of the last `num_logits` new
+        positions (all of them if None). The vocabulary projection is skipped
+        for the other positions, and entirely (returning None) for 0.
+        """
+        past_key_values, attention_mask = self.begin(start, end, input_ids.shape[1])
+        out = model.get_decoder()(input_ids=input_ids, use_cache=True,
+                                  attention_mask=attention_mask,
+                                  past_key_values=past_key_values)
+        self.commit()
+        hidden_states = out.last_hidden_state
+        if num_logits is not None:
+            if num_logits == 0:
+                return None
+            hidden_states = hidden_states[:, -num_logits:]
+        return model.get_output_embeddings()(hidden_states)
+
+
+class StaticLayerCache:
+    """The view of a StaticKVCache that one decoder layer sees."""
+
+    def __init__(self, cache, layer):
+        self.cache = cache
+        self.layer = layer
+
+    def __getitem__(self, i):
+        # HF reads `past_key_values[0][0].shape[2]` as the past length.
+        c = self.cache
+        buf = c.keys if i == 0 else c.values
+        return buf[self.layer, c.start:c.end, :, :c.past_len]
+
+    def update(self, key_states, value_states):
+        """Write the new [batch, heads, new, head_dim] states in place and
+        return views of all keys and values the new tokens attend to."""
+        c = self.cache
+        rows = torch.arange(c.start, c.end).unsqueeze(-1)
+        keys, values = c.keys[self.layer], c.values[self.layer]
+        keys[rows, :, c.write_pos] = key_states.transpose(1, 2)
+        values[rows, :, c.write_pos] = value_states.transpose(1, 2)
+        view_len = c.past_len + c.num_new
+        return (keys[c.start:c.end, :, :view_len],
+                values[c.start:c.end, :, :view_len])
+
+
+def _static_attention_forward(self, hidden_states, key_value_states=None,
+                              past_key_value=None, attention_mask=None,
+                              layer_head_mask=None, output_attentions=False):
+    if not isinstance(past_key_value, StaticLayerCache):
+        return self._dynamic_forward(
+            hidden_states, key_value_states=key_value_states,
+            past_key_value=past_key_value, attention_mask=attention_mask,
+            layer_head_mask=layer_head_mask, output_attentions=output_attentions)
+
+    # The right-padded layout of the cache makes HF's 4D mask
+    # meaningless here; the cache provides its own additive bias.
+    bsz, tgt_len, _ = hidden_states.size()
+    query_states = self._shape(self.q_proj(hidden_states) * self.scaling, tgt_len, bsz)
+    key_states = self._shape(self.k_proj(hidden_states), tgt_len, bsz)
+    value_states = self._shape(self.v_proj(hidden_states), tgt_len, bsz)
+    key_states, value_states = past_key_value.update(key_states, value_states)
+
+    attn_weights = torch.matmul(query_states, key_states.transpose(-1, -2))
+    attn_weights = attn_weights + past_key_value.cache.bias
+    attn_weights = torch.nn.functional.softmax(attn_weights, dim=-1)
+    if layer_head_mask is not None:
+        attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights
+
+    attn_output = torch.matmul(attn_weights, value_states)
+    attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+    attn_output = self.out_proj(attn_output)
+    return attn_output, None, past_key_value
+
+
+def patch_static_attention(model):
+    """Let the OPT attention layers of `model` run on a StaticKVCache."""
+    for module in model.modules():
+        if type(module).__name__ == "OPTAttention" and not hasattr(module, "_dynamic_forward"):
+            module._dynamic_forward = module.forward
+            module.forward = types.MethodType(_static_attention_forward, module)
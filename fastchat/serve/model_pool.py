@@ -0,0 +1,68 @@
+"""
+The models of a worker that are resident in memory.
+"""
+import asyncio
+import collections
+import gc
+
+
+class ModelPool:
+    """
+    Load models on first use and keep them resident up to `max_bytes` (0
+    means no limit), unloading the least recently used idle models to make
+    room for another one. `sizes` maps the name of every model to the bytes
+    it takes when loaded.
+
+    `load(name)` returns the resident model, which has a `users` count and
+    `busy()` and `unload()` methods. It runs in a thread, so that loading
+    does not stall the requests of the other models. A model that is in use
+    is never unloaded, so the budget is exceeded while all others are busy.
+    """
+
+    def __init__(self, sizes, load, max_bytes=0):
+        self.sizes = dict(sizes)
+        self.names = list(sizes)
+        self.load = load
+        self.max_bytes = max_bytes
+        self.resident = collections.OrderedDict()
+        self.lock = None
+
+    def resolve(self, name):
+        """The model serving requests for `name`; unknown names get the first one."""
+        return name if name in self.sizes else self.names[0]
+
+    def preload(self, name, model):
+        """Make the already loaded `model` resident under `name`."""
+        self.resident[name] = model
+
+    async def acquire(self, name):
+        name = self.resolve(name)
+        if name not in self.resident:
+            if self.lock is None:
+                self.lock = asyncio.Lock()
+            async with self.lock:
+                if name not in self.resident:
+                    self.make_room(self.sizes[name])
+                    loop = asyncio.get_running_loop()
+                    self.resident[name] = await loop.run_in_executor(None, self.load, name)
+        self.resident.move_to_end(name)
+        model = self.resident[name]
+        model.users += 1
+        return model
+
+    def release(self, model):
+        model.users -= 1
+
+    def num_bytes(self):
+        return sum(self.sizes[name] for name in self.resident)
+
+    def make_room(self, num_bytes):
+        if self.max_bytes <= 0:
+            return
+        for name, model in list(self.resident.items()):
+            if self.num_bytes() + num_bytes <= self.max_bytes:
+                break
+            if model.users == 0 and not model.busy():
+                del self.resident[name]
+                model.unload()
+        gc.collect()
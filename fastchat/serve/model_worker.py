@@ -3,7 +3,11 @@ A model worker executes the model.
 """
 import argparse
 import asyncio
+import collections
 import dataclasses
+import functools
+import hashlib
+import inspect
 import logging
 import json
 import time
@@ -18,7 +22,19 @@ from transformers import AutoTokenizer, OPTForCausalLM,  set_seed
 import torch
 import uvicorn
 
-from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.constants import WORKER_HEART_BEAT_INTERVAL, WORKER_DISCONNECT_POLL_INTERVAL
+from fastchat.conversation import conv_templates
+from fastchat.serve.detokenizer import IncrementalDetokenizer
+from fastchat.serve.int8_weights import is_int8_file, load_int8_model
+from fastchat.serve.model_pool import ModelPool
+from fastchat.serve.prefix_cache import PrefixCache
+from fastchat.serve.response_cache import ResponseCache
+from fastchat.serve.sampling import SamplingParams
+from fastchat.serve.scheduler import BatchScheduler, GenerationRequest
+from fastchat.serve.single_flight import SharedStream
+from fastchat.serve.speculative import DraftModelProposer, NgramProposer
+from fastchat.serve.stop_matcher import StopMatcher
+from fastchat.utils import server_error_msg, invalid_request_msg
 
 from utils import Utils
 import gc 
@@ -29,7 +45,7 @@ import qlinear
 set_seed(123)
 logger_use = False
 if logger_use == True:
-    from fastchat.utils import (build_logger, server_error_msg, pretty_print_semaphore)
+    from fastchat.utils import (build_logger, pretty_print_semaphore)
 
 GB = 1 << 30
 
@@ -46,24 +62,95 @@ def heart_beat_worker(controller):
         time.sleep(WORKER_HEART_BEAT_INTERVAL)
         controller.send_heart_beat()
 
-def load_model(model_path, model_file, num_gpus):
+async def abort_on_disconnect(abort, is_disconnected):
+    """Call `abort` as soon as the client is gone, even while it is queued."""
+    while not await is_disconnected():
+        await asyncio.sleep(WORKER_DISCONNECT_POLL_INTERVAL)
+    abort()
+
+class InvalidRequestError(Exception):
+    """The parameters of a request are malformed or out of range."""
+
+
+async def collect_output(index, req):
+    output = ""
+    while True:
+        text = await req.output_queue.get()
+        if text is None:
+            ret = {"index": index, "text": output, "error_code": 0}
+            if req.score_prompt:
+                ret["prompt_logprobs"] = req.prompt_logprobs
+            return ret
+        if isinstance(text, Exception):
+            return {"index": index, "text": server_error_msg, "error_code": 1}
+        output += text
+
+# Bump when the deployment steps change, to invalidate deployed models.
+DEPLOY_VERSION = 1
+node_args = ()
+node_kwargs = {}
+
+def deployed_model_file(model_file):
+    """
+    Where `compile_model` saves the deployed `model_file`. The name carries
+    a hash of everything the deployment depends on, so a deployed model is
+    only found while it is up to date.
+    """
+    stat = os.stat(model_file)
+    inputs = [DEPLOY_VERSION, os.path.basename(model_file), stat.st_size, stat.st_mtime_ns,
+              torch.__version__, getattr(qlinear, "__version__", None),
+              repr(node_args), repr(node_kwargs)]
+    for source in [qlinear.__file__, inspect.getsourcefile(Utils)]:
+        with open(source, "rb") as fin:
+            inputs.append(hashlib.sha256(fin.read()).hexdigest())
+    digest = hashlib.sha256(json.dumps(inputs).encode()).hexdigest()[:16]
+    return f"{os.path.splitext(model_file)[0]}.{digest}.deployed.pth"
+
+def deploy_model(model_file):
+    """Load `model_file` with its linear layers replaced by QLinear."""
+    if is_int8_file(model_file):
+        print("Map INT8 model...")
+        def make_linear(in_features, out_features, weight_bias):
+            layer = qlinear.QLinear(*node_args, **node_kwargs)
+            layer.in_features = in_features
+            layer.out_features = out_features
+            layer.weight_bias = weight_bias
+            layer.quantize_weights()
+            return layer
+        model = load_int8_model(model_file, make_linear)
+    else:
+        print("Load INT8 model...")
+        model = torch.load(model_file)
+        model.eval()
+
+        print("Deploy smooth quant...")
+        Utils.replace_node( model, 
+                            torch.ao.nn.quantized.dynamic.modules.linear.Linear,
+                            qlinear.QLinear, 
+                            node_args, node_kwargs 
+                          )
+    collected = gc.collect()
+    return model
+
+def load_tokenizer(model_path):
     model_org =  model_path.split("/")[0]
     #model_name = model_path.split("/")[1]
     model_name = "opt-1.3b"
-    tokenizer = AutoTokenizer.from_pretrained("facebook/opt-1.3b") #exception: hard-coded
-    print("Load INT8 model...")
-    model = torch.load(model_file)
-    model.eval()
-
-    node_args = ()
-    node_kwargs = {}
-    print("Deploy smooth quant...")
-    Utils.replace_node( model, 
-                        torch.ao.nn.quantized.dynamic.modules.linear.Linear,
-                        qlinear.QLinear, 
-                        node_args, node_kwargs 
-                      )
-    collected = gc.collect()
+    return AutoTokenizer.from_pretrained("facebook/opt-1.3b") #exception: hard-coded
+
+def load_model(model_file, num_gpus):
+    deployed_file = deployed_model_file(model_file)
+    model = None
+    if os.path.exists(deployed_file):
+        print(f"Load deployed model {deployed_file}...")
+        try:
+            model = torch.load(deployed_file)
+            model.eval()
+        except Exception as e:
+            print(f"Warning: cannot load deployed model {deployed_file} ({e}), deploying {model_file}...")
+            model = None
+    if model is None:
+        model = deploy_model(model_file)
 
     if num_gpus == 1:
         model.cuda("cuda:0")
@@ -73,12 +160,54 @@ def load_model(model_path, model_file, num_gpus):
     else:
         context_len = 2048 # opt
 
-    return tokenizer, model, context_len
+    return model, context_len
+
+def model_names(model_files):
+    """The name every model file is served under."""
+    if len(model_files) == 1:
+        return {"opt-1.3b": model_files[0]}
+    names = {}
+    for model_file in model_files:
+        name = os.path.splitext(os.path.basename(model_file))[0]
+        if name.startswith("quantized_"):
+            name = name[len("quantized_"):]
+        if name in names:
+            raise ValueError(f"{names[name]} and {model_file} would both be served as {name}")
+        names[name] = model_file
+    return names
+
+class ServedModel:
+    """A resident model and the scheduler that runs its requests."""
+
+    def __init__(self, name, model_file, model, context_len, scheduler,
+                 num_speculative_tokens):
+        self.name = name
+        self.model_file = model_file
+        # Identifies the loaded model in cache keys: changes when the model
+        # file is replaced, even under the same name.
+        self.model_id = os.path.basename(deployed_model_file(model_file))
+        self.model = model
+        self.context_len = context_len
+        self.scheduler = scheduler
+        self.num_speculative_tokens = num_speculative_tokens
+        self.users = 0
+
+    def busy(self):
+        load = self.scheduler.load()
+        return load["num_running"] + load["num_waiting"] > 0
+
+    def unload(self):
+        print(f"Unload model {self.name}...")
+        self.scheduler.stop()
 
 class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
-                 model_path, model_file, num_gpus
+                 model_path, model_files, num_gpus,
+                 max_batch_size, prefix_cache_gb, prefill_chunk_size,
+                 draft_model_file, num_speculative_tokens, prompt_lookup_ngram,
+                 response_cache_mb, response_cache_dir, response_cache_disk_mb,
+                 model_memory_gb
                  ):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
@@ -86,17 +215,74 @@ class ModelWorker:
         if model_path.endswith("/"):
             model_path = model_path[:-1]
         #self.model_name = model_path.split("/")[-1]
-        self.model_name = "opt-1.3b"
+        self.model_files = model_names(model_files)
+        self.model_names = list(self.model_files)
 
         if logger_use == True:
-            logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
-        self.tokenizer, self.model, self.context_len = load_model(model_path, model_file, num_gpus)
+            logger.info(f"Loading the models {self.model_names} on worker {worker_id} ...")
+        self.num_gpus = num_gpus
+        self.max_batch_size = max_batch_size
+        self.prefix_cache_gb = prefix_cache_gb
+        self.prefill_chunk_size = prefill_chunk_size
+        self.num_speculative_tokens = num_speculative_tokens
+        self.prompt_lookup_ngram = prompt_lookup_ngram
+        # Every model shares the tokenizer and the draft model.
+        self.tokenizer = load_tokenizer(model_path)
+        self.draft_model = None
+        if draft_model_file:
+            print("Load draft model for speculative decoding...")
+            self.draft_model, _ = load_model(draft_model_file, num_gpus)
+        # A model takes about the size of its file plus its caches, which are
+        # the same for every model of the worker as for the first one.
+        first = self.load_served_model(self.model_names[0])
+        cache_bytes = first.scheduler.cache_bytes()
+        sizes = {name: os.path.getsize(model_file) + cache_bytes
+                 for name, model_file in self.model_files.items()}
+        self.models = ModelPool(sizes, self.load_served_model, int(model_memory_gb * GB))
+        self.models.preload(self.model_names[0], first)
+        # Deterministic requests being generated, by key; identical ones
+        # subscribe to the same stream instead of running again.
+        self.in_flight = {}
+        self.response_cache = None
+        if response_cache_mb > 0:
+            self.response_cache = ResponseCache(int(response_cache_mb * (1 << 20)),
+                                                response_cache_dir,
+                                                int(response_cache_disk_mb * (1 << 20)))
 
         if not no_register:
             self.register_to_controller()
             self.heart_beat_thread = threading.Thread(target=heart_beat_worker, args=(self,))
             self.heart_beat_thread.start()
 
+    def load_served_model(self, name):
+        model_file = self.model_files[name]
+        print(f"Load model {name}...")
+        model, context_len = load_model(model_file, self.num_gpus)
+        prefix_cache = None
+        if self.prefix_cache_gb > 0:
+            prefix_cache = PrefixCache(int(self.prefix_cache_gb * GB))
+        proposer = None
+        if self.draft_model is not None:
+            proposer = DraftModelProposer(self.draft_model, self.num_speculative_tokens,
+                                          self.max_batch_size, context_len)
+        elif self.prompt_lookup_ngram > 0:
+            proposer = NgramProposer(self.prompt_lookup_ngram, self.num_speculative_tokens)
+        scheduler = BatchScheduler(model, self.tokenizer.eos_token_id,
+                                   self.max_batch_size, context_len, prefix_cache,
+                                   self.prefill_chunk_size, proposer)
+        if prefix_cache is not None:
+            self.pin_conversation_templates(scheduler)
+        return ServedModel(name, model_file, model, context_len, scheduler,
+                           self.num_speculative_tokens if proposer is not None else 0)
+
+    def pin_conversation_templates(self, scheduler):
+        """Prefill the fixed system prompt and examples of every template once."""
+        print("Pin conversation templates...")
+        for name, conv in conv_templates.items():
+            token_ids = self.tokenizer(conv.get_prompt()).input_ids
+            scheduler.pin_prefix(token_ids)
+            print(f"  {name}: {len(token_ids)} prompt tokens reused per request")
+
     def register_to_controller(self):
         if logger_use == True:
             logger.info("Register to controller")
@@ -112,7 +298,7 @@ class ModelWorker:
 
     def send_heart_beat(self):
         if logger_use == True:
-            logger.info(f"Send heart beat. Models: {[self.model_name]}. " f"Semaphore: {pretty_print_semaphore(model_semaphore)}. " f"global_counter: {global_counter}")
+            logger.info(f"Send heart beat. Models: {self.model_names}. " f"Semaphore: {pretty_print_semaphore(model_semaphore)}. " f"global_counter: {global_counter}")
 
         url = self.controller_addr + "/receive_heart_beat"
 
@@ -120,7 +306,7 @@ class ModelWorker:
             try:
                 ret = requests.post(url, json={
                     "worker_name": self.worker_addr,
-                    "queue_length": self.get_queue_length()}, timeout=5)
+                    **self.get_load()}, timeout=5)
                 exist = ret.json()["exist"]
                 break
             except requests.exceptions.RequestException as e:
@@ -132,87 +318,233 @@ class ModelWorker:
         if not exist:
             self.register_to_controller()
 
-    def get_queue_length(self):
-        if model_semaphore is None:
-            return 0
-        else:
-            # Fixed
-            #return args.limit_model_concurrency - model_semaphore._value + len(model_semaphore._waiters)
-            return args.limit_model_concurrency 
+    def get_queue_length(self, load=None):
+        load = load or self.scheduler_load()
+        queue_length = load["num_running"] + load["num_waiting"]
+        if model_semaphore is not None and model_semaphore._waiters:
+            # Requests over the concurrency limit have not reached the
+            # scheduler yet.
+            queue_length += len(model_semaphore._waiters)
+        return queue_length
+
+    def scheduler_load(self):
+        """The load of the schedulers of all resident models, summed."""
+        load = {"num_running": 0, "num_waiting": 0, "pending_tokens": 0,
+                "decode_tokens_per_s": 0.0}
+        for served in list(self.models.resident.values()):
+            for key, value in served.scheduler.load().items():
+                load[key] = load.get(key, 0) + value
+        return load
+
+    def get_load(self):
+        load = self.scheduler_load()
+        load["queue_length"] = self.get_queue_length(load)
+        return load
 
     def get_status(self):
-        return {
-            "model_names": [self.model_name],
+        status = {
+            "model_names": self.model_names,
             "speed": 1,
-            "queue_length": self.get_queue_length(),
+            # Requests that run at once without queuing.
+            "capacity": self.max_batch_size,
+            **self.get_load(),
+            "resident_models": list(self.models.resident),
         }
-
-    @torch.inference_mode()
-    def generate_stream(self, params):
-        tokenizer, model = self.tokenizer, self.model
+        speculative = {name: served.scheduler.speculative_stats()
+                       for name, served in list(self.models.resident.items())
+                       if served.num_speculative_tokens > 0}
+        if speculative:
+            status["speculative"] = speculative
+        if self.response_cache is not None:
+            status["response_cache"] = self.response_cache.stats()
+        return status
+
+    def make_request(self, params, served):
+        tokenizer = self.tokenizer
 
         prompt = params["prompt"]
-        l_prompt = len(prompt)
-        temperature = float(params.get("temperature", 1.0))
-        max_new_tokens = min(int(params.get("max_new_tokens", 256)), 1024)
+        try:
+            sampling_params = SamplingParams(
+                temperature=float(params.get("temperature", 1.0)),
+                top_k=int(params.get("top_k", 0)),
+                top_p=float(params.get("top_p", 1.0)),
+                min_p=float(params.get("min_p", 0.0)),
+                repetition_penalty=float(params.get("repetition_penalty", 1.0)),
+                frequency_penalty=float(params.get("frequency_penalty", 0.0)))
+            max_new_tokens = min(int(params.get("max_new_tokens", 256)), 1024)
+        except (TypeError, ValueError) as e:
+            raise InvalidRequestError(str(e)) from e
+        # Out of range values would fail the sampling of the whole batch.
+        p = sampling_params
+        if not (p.temperature >= 0 and 0 < p.top_p <= 1 and 0 <= p.min_p <= 1 and
+                p.repetition_penalty > 0 and p.top_k >= 0):
+            raise InvalidRequestError("invalid sampling parameters")
         stop_str = params.get("stop", None)
+        if isinstance(stop_str, str):
+            stop_str = [stop_str]
+        stop_token_ids = params.get("stop_token_ids", None) or []
+        # Scoring clients can ask for the log-probabilities of the prompt
+        # tokens, which costs the logits of every prompt position.
+        score_prompt = bool(params.get("prompt_logprobs", False))
 
         input_ids = tokenizer(prompt).input_ids
-        output_ids = list(input_ids)
 
-        max_src_len = self.context_len - max_new_tokens - 8
+        # Verification writes the speculative tokens past the output.
+        max_src_len = served.context_len - max_new_tokens - 8 - served.num_speculative_tokens
         input_ids = input_ids[-max_src_len:]
 
-        for i in range(max_new_tokens):
-            if i == 0: # initial tkn gen
-                out = model(torch.as_tensor([input_ids]), use_cache=True)
-                logits = out.logits
-                past_key_values = out.past_key_values
-            else:
-                attention_mask = torch.ones(1, past_key_values[0][0].shape[-2] + 1)
-                out = model(input_ids=torch.as_tensor([[token]]), use_cache=True, attention_mask=attention_mask, past_key_values=past_key_values)
-                logits = out.logits
-                past_key_values = out.past_key_values
-
-            last_token_logits = logits[0][-1]
-            if temperature < 1e-4:
-                token = int(torch.argmax(last_token_logits))
-            else:
-                probs = torch.softmax(last_token_logits / temperature, dim=-1)
-                token = int(torch.multinomial(probs, num_samples=1))
+        return GenerationRequest(input_ids, sampling_params, max_new_tokens,
+                                 IncrementalDetokenizer(tokenizer, input_ids),
+                                 StopMatcher(stop_str or []), stop_token_ids,
+                                 score_prompt)
 
-            output_ids.append(token)
-            #print(output_ids)
-
-            if token == tokenizer.eos_token_id:
-                stopped = True
+    def deterministic_key(self, params, req, served):
+        """A key identifying the output of a deterministic request, or None."""
+        if req.score_prompt or req.sampling_params.temperature >= 1e-4:
+            return None
+        stop_str = params.get("stop", None)
+        if isinstance(stop_str, str):
+            stop_str = [stop_str]
+        p = req.sampling_params
+        return ResponseCache.make_key(
+            served.model_id, hashlib.sha256(str(req.input_ids).encode()).hexdigest(),
+            req.max_new_tokens, stop_str, sorted(req.stop_token_ids),
+            p.repetition_penalty, p.frequency_penalty)
+
+    async def generate_stream(self, params, is_disconnected=None):
+        prompt = params["prompt"]
+        # In delta mode every chunk carries only the text appended since the
+        # previous chunk instead of the prompt plus the whole output.
+        delta = bool(params.get("delta", False))
+
+        # The scheduler thread runs the model, detokenizes and matches stop
+        # strings at every step; this generator only frames the text of its
+        # own request on the event loop.
+        served = await self.models.acquire(params.get("model"))
+        stream = queue = watcher = None
+        try:
+            req = self.make_request(params, served)
+            key = self.deterministic_key(params, req, served)
+            cached = None
+            if key is not None and self.response_cache is not None:
+                cached = self.response_cache.get(key)
+            if cached is not None:
+                # Replay the text deltas of the same request run before.
+                replay = iter(cached + [None])
+                async def next_item():
+                    return next(replay)
             else:
-                stopped = False
-
-            if i % args.stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-                #output = tokenizer.decode(output_ids, skip_special_tokens=True)
-                output = tokenizer.decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
-                pos = output.rfind(stop_str, l_prompt)
-                if pos != -1:
-                    output = output[:pos]
-                    stopped = True
-
-                ret = {
-                    "text": output,
-                    "error_code": 0,
-                }
-                yield json.dumps(ret).encode() + b"\0"
-
-            if stopped:
-                break
-
-        del past_key_values
-
-    def generate_stream_gate(self, params):
+                stream = self.in_flight.get(key) if key is not None else None
+                if stream is None:
+                    served.scheduler.submit(req)
+                    stream = SharedStream(req, functools.partial(self.finish_stream, key))
+                    if key is not None:
+                        self.in_flight[key] = stream
+                queue = stream.subscribe()
+                next_item = queue.get
+                if is_disconnected is not None:
+                    watcher = asyncio.create_task(abort_on_disconnect(
+                        functools.partial(stream.unsubscribe, queue), is_disconnected))
+
+            output = prompt
+            sent = len(prompt)
+            i = 0
+            while True:
+                text = await next_item()
+                if isinstance(text, Exception):
+                    ret = {
+                        "text": server_error_msg,
+                        "error_code": 1,
+                    }
+                    yield json.dumps(ret).encode() + b"\0"
+                    break
+                stopped = text is None
+                if not stopped:
+                    output += text
+
+                if i % args.stream_interval == 0 or stopped:
+                    ret = {
+                        "text": output[sent:] if delta else output,
+                        "error_code": 0,
+                    }
+                    if cached is None:
+                        # Lets the controller measure the decoding speed.
+                        ret["num_tokens"] = i if stopped else i + 1
+                    if stopped and req.score_prompt:
+                        ret["prompt_logprobs"] = req.prompt_logprobs
+                    sent = len(output)
+                    yield json.dumps(ret).encode() + b"\0"
+
+                if stopped:
+                    break
+                i += 1
+        finally:
+            # The request leaves the batch when its last client goes away.
+            if stream is not None:
+                stream.unsubscribe(queue)
+            if watcher is not None:
+                watcher.cancel()
+            self.models.release(served)
+
+    def finish_stream(self, key, stream):
+        if key is None:
+            return
+        if self.in_flight.get(key) is stream:
+            del self.in_flight[key]
+        if (self.response_cache is not None and stream.final is None and
+                not stream.req.aborted):
+            self.response_cache.put(key, stream.texts)
+
+    async def generate_batch(self, batch, model_name=None):
+        """
+        Generate the outputs of a list of requests (each with the parameters
+        of generate_stream) and yield one JSON line per request as soon as it
+        is done: its index in `batch`, the generated text without the
+        prompt and an error code. All of them run on the model `model_name`.
+
+        Prompts are run shortest first and at most one batch of them is in
+        the scheduler at any time, so that interactive requests still get
+        their share of the batch.
+        """
+        served = await self.models.acquire(model_name)
+        reqs = {}
+        tasks = set()
         try:
-            for x in self.generate_stream(params):
+            for i, params in enumerate(batch):
+                try:
+                    reqs[i] = self.make_request(params, served)
+                except InvalidRequestError as e:
+                    ret = {"index": i, "text": f"{invalid_request_msg} ({e})", "error_code": 4}
+                    yield json.dumps(ret).encode() + b"\n"
+            pending = collections.deque(sorted(reqs, key=lambda i: len(reqs[i].input_ids)))
+            while pending or tasks:
+                while pending and len(tasks) < served.scheduler.max_batch_size:
+                    i = pending.popleft()
+                    served.scheduler.submit(reqs[i])
+                    tasks.add(asyncio.create_task(collect_output(i, reqs[i])))
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield json.dumps(task.result()).encode() + b"\n"
+        finally:
+            for req in reqs.values():
+                req.abort()
+            for task in tasks:
+                task.cancel()
+            self.models.release(served)
+
+    async def generate_stream_gate(self, params, is_disconnected=None):
+        try:
+            async for x in self.generate_stream(params, is_disconnected):
                 yield x
-        except torch.cuda.OutOfMemoryError:
+        except InvalidRequestError as e:
+            ret = {
+                "text": f"{invalid_request_msg} ({e})",
+                "error_code": 4,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+        except Exception:
+            # E.g. a model that fails to load; the client gets an error
+            # message instead of a broken stream.
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
@@ -236,12 +568,19 @@ async def generate_stream(request: Request):
     if model_semaphore is None:
         model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
     await model_semaphore.acquire()
-    generator = worker.generate_stream_gate(params)
+    generator = worker.generate_stream_gate(params, request.is_disconnected)
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_model_semaphore)
     return StreamingResponse(generator, background=background_tasks)
 
 
+@app.post("/worker_generate_batch")
+async def generate_batch(request: Request):
+    params = await request.json()
+    generator = worker.generate_batch(params["prompts"], params.get("model"))
+    return StreamingResponse(generator, media_type="application/x-ndjson")
+
+
 @app.post("/worker_get_status")
 async def get_status(request: Request):
     return worker.get_status()
@@ -254,12 +593,26 @@ if __name__ == "__main__":
     parser.add_argument("--worker-address", type=str, default="http://127.0.0.1:21002")
     parser.add_argument("--controller-address", type=str, default="http://127.0.0.1:21005")
     parser.add_argument("--model-path", type=str, default="facebook/opt-1.3b", choices=["facebook/opt-1.3b", "local_dir/chatopt_1.3b_gpt4only", "local_dir/amd-hardcoded"])
-    parser.add_argument("--model-file", type=str, default="quantized_opt-1.3b.pth", choices=["quantized_opt-1.3b.pth", "quantized_chatopt_1.3b_gpt4only.pth", "quantized_opt1.3b_merged_cnn-daily-0.3_gpt4-wo-orca-0822-clean97k-amd-hardcoded_continue-bingchat-amd.pth"])
+    parser.add_argument("--model-file", type=str, nargs="+", default=["quantized_opt-1.3b.pth"], choices=[f"{name}.{ext}" for name in ["quantized_opt-1.3b", "quantized_chatopt_1.3b_gpt4only", "quantized_opt1.3b_merged_cnn-daily-0.3_gpt4-wo-orca-0822-clean97k-amd-hardcoded_continue-bingchat-amd"] for ext in ["pth", "int8"]])
     parser.add_argument("--num-gpus", type=int, default=0)
     parser.add_argument("--limit-model-concurrency", type=int, default=5)
     parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument("--max-batch-size", type=int, default=5)
+    parser.add_argument("--prefix-cache-gb", type=float, default=1.0)
+    parser.add_argument("--prefill-chunk-size", type=int, default=256)
+    parser.add_argument("--draft-model-file", type=str, default=None)
+    parser.add_argument("--num-speculative-tokens", type=int, default=4)
+    parser.add_argument("--prompt-lookup-ngram", type=int, default=0)
+    parser.add_argument("--response-cache-mb", type=float, default=64)
+    parser.add_argument("--response-cache-dir", type=str, default=None)
+    parser.add_argument("--response-cache-disk-mb", type=float, default=1024)
+    parser.add_argument("--model-memory-gb", type=float, default=0)
+    parser.add_argument("--num-torch-threads", type=int, default=0)
     parser.add_argument("--no-register", action="store_true")
     args = parser.parse_args()
+    if args.num_torch_threads > 0:
+        # Only the scheduler thread runs the model, so it can have all cores.
+        torch.set_num_threads(args.num_torch_threads)
     if logger_use == True:
         logger.info(f"args: {args}")
 
@@ -269,6 +622,16 @@ if __name__ == "__main__":
                          args.no_register,
                          args.model_path,
                          args.model_file,
-                         args.num_gpus
+                         args.num_gpus,
+                         args.max_batch_size,
+                         args.prefix_cache_gb,
+                         args.prefill_chunk_size,
+                         args.draft_model_file,
+                         args.num_speculative_tokens,
+                         args.prompt_lookup_ngram,
+                         args.response_cache_mb,
+                         args.response_cache_dir,
+                         args.response_cache_disk_mb,
+                         args.model_memory_gb
                          )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
\ No newline at end of file
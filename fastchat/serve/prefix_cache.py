@@ -0,0 +1,131 @@
+"""
+A cross-request cache of key/value states keyed by token prefix.
+"""
+
+
+class _Node:
+    def __init__(self, parent, tokens, keys, values):
+        self.parent = parent
+        self.tokens = tokens
+        # [layers, heads, len(tokens), head_dim]
+        self.keys = keys
+        self.values = values
+        self.children = {}
+        self.last_access = 0
+        self.pinned = False
+
+    @property
+    def num_bytes(self):
+        if self.keys is None:
+            return 0
+        return 2 * self.keys.numel() * self.keys.element_size()
+
+
+def _common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixCache:
+    """
+    A radix tree over token ids whose edges hold the key/value states of
+    their tokens.
+
+    `match` returns the states of the longest cached prefix of a prompt so
+    that only the rest of it has to be prefilled; `insert` adds the states of
+    a finished sequence, storing only the part that is not cached yet. Least
+    recently used leaves are evicted whenever the stored states exceed
+    `max_bytes`. Prefixes inserted with `pinned=True` are never evicted.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.root = _Node(None, [], None, None)
+        self.clock = 0
+
+    def match(self, token_ids):
+        """Return the length of the longest cached prefix of `token_ids` and
+        its (keys, values) segments."""
+        self.clock += 1
+        node, pos, segments = self.root, 0, []
+        while pos < len(token_ids):
+            child = node.children.get(token_ids[pos])
+            if child is None:
+                break
+            n = _common_prefix_len(child.tokens, token_ids[pos:])
+            child.last_access = self.clock
+            segments.append((child.keys[:, :, :n], child.values[:, :, :n]))
+            pos += n
+            if n < len(child.tokens):
+                break
+            node = child
+        return pos, segments
+
+    def insert(self, token_ids, keys, values, pinned=False):
+        """Cache the [layers, heads, len(token_ids), head_dim] states of `token_ids`."""
+        self.clock += 1
+        node, pos = self.root, 0
+        while pos < len(token_ids):
+            child = node.children.get(token_ids[pos])
+            if child is None:
+                child = _Node(node, list(token_ids[pos:]),
+                              keys[:, :, pos:].clone(), values[:, :, pos:].clone())
+                node.children[token_ids[pos]] = child
+                self.num_bytes += child.num_bytes
+                n = len(child.tokens)
+            else:
+                n = _common_prefix_len(child.tokens, token_ids[pos:])
+                if n < len(child.tokens):
+                    child = self._split(child, n)
+            child.last_access = self.clock
+            child.pinned = child.pinned or pinned
+            node, pos = child, pos + n
+        self.evict()
+
+    def _split(self, node, n):
+        """Split the edge of `node` after `n` tokens and return the upper half."""
+        upper = _Node(node.parent, node.tokens[:n],
+                      node.keys[:, :, :n].clone(), node.values[:, :, :n].clone())
+        upper.last_access = node.last_access
+        upper.pinned = node.pinned
+        node.parent.children[upper.tokens[0]] = upper
+
+        self.num_bytes -= node.num_bytes
+        node.parent = upper
+        node.tokens = node.tokens[n:]
+        node.keys = node.keys[:, :, n:].clone()
+        node.values = node.values[:, :, n:].clone()
+        upper.children[node.tokens[0]] = node
+        self.num_bytes += node.num_bytes + upper.num_bytes
+        return upper
+
+    def evictable(self, node):
+        return not node.children and not node.pinned
+
+    def evict(self):
+        if self.num_bytes <= self.max_bytes:
+            return
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if node is not self.root and self.evictable(node):
+                leaves.append(node)
+
+        leaves.sort(key=lambda x: x.last_access, reverse=True)
+        while leaves and self.num_bytes > self.max_bytes:
+            node = leaves.pop()
+            parent = node.parent
+            del parent.children[node.tokens[0]]
+            self.num_bytes -= node.num_bytes
+            if parent is not self.root and self.evictable(parent):
+                # Keep the list ordered by last access.
+                i = 0
+                while i < len(leaves) and leaves[i].last_access > parent.last_access:
+                    i += 1
+                leaves.insert(i, parent)
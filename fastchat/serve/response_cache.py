@@ -0,0 +1,137 @@
+"""
+An exact-match cache of the outputs of deterministic requests.
+"""
+import collections
+import hashlib
+import json
+import os
+import sys
+
+
+class ResponseCache:
+    """
+    A least-recently-used map from a request key to the text deltas of its
+    generated tokens, bounded by `max_bytes` of memory. Replaying the deltas
+    reproduces the stream of the original request chunk by chunk.
+
+    With `disk_dir`, every entry is also written there as a JSON file, so
+    entries survive evictions from memory and restarts of the worker. The
+    files are bounded by `max_disk_bytes` in the same least-recently-used
+    order, which the modification times carry over restarts.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        # Dict[key -> file size] of the files in disk_dir, oldest first.
+        self.disk_entries = collections.OrderedDict()
+        self.disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.scan_disk()
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash JSON-serializable `parts` into a key."""
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, key):
+        texts = self.entries.get(key)
+        if texts is not None:
+            self.entries.move_to_end(key)
+            if key in self.disk_entries:
+                self.disk_entries.move_to_end(key)
+        elif self.disk_dir:
+            texts = self.load(key)
+            if texts is not None:
+                self.insert(key, texts)
+        if texts is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return texts
+
+    def put(self, key, texts):
+        self.insert(key, texts)
+        if self.disk_dir:
+            path = self.path(key)
+            with open(path + ".tmp", "w") as fout:
+                json.dump(texts, fout)
+            os.replace(path + ".tmp", path)
+            self.touch_disk(key, os.path.getsize(path))
+
+    def path(self, key):
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def load(self, key):
+        try:
+            with open(self.path(key)) as fin:
+                texts = json.load(fin)
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            return None
+        self.touch_disk(key, os.path.getsize(self.path(key)))
+        return texts
+
+    def scan_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                files.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk_entries[key] = size
+            self.disk_bytes += size
+        self.evict_disk()
+
+    def touch_disk(self, key, size):
+        """Record `key` as the most recently used file and evict old ones."""
+        self.disk_bytes -= self.disk_entries.pop(key, 0)
+        self.disk_entries[key] = size
+        self.disk_bytes += size
+        self.evict_disk()
+
+    def evict_disk(self):
+        if self.max_disk_bytes <= 0:
+            return
+        while self.disk_entries and self.disk_bytes > self.max_disk_bytes:
+            key, size = self.disk_entries.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    @staticmethod
+    def entry_bytes(key, texts):
+        return (sys.getsizeof(key) + sys.getsizeof(texts) +
+                sum(sys.getsizeof(text) for text in texts))
+
+    def insert(self, key, texts):
+        if key in self.entries:
+            self.num_bytes -= self.entry_bytes(key, self.entries.pop(key))
+        size = self.entry_bytes(key, texts)
+        if size > self.max_bytes:
+            return
+        while self.num_bytes + size > self.max_bytes:
+            old_key, old_texts = self.entries.popitem(last=False)
+            self.num_bytes -= self.entry_bytes(old_key, old_texts)
+        self.entries[key] = texts
+        self.num_bytes += size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "num_entries": len(self.entries),
+            "num_bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+            "disk_bytes": self.disk_bytes,
+        }
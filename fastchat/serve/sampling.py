@@ -0,0 +1,166 @@
+"""
+Batched logits processing and sampling.
+"""
+import torch
+
+
+class SamplingParams:
+    """The sampling controls of one request; neutral values disable them."""
+
+    def __init__(self, temperature=1.0, top_k=0, top_p=1.0, min_p=0.0,
+                 repetition_penalty=1.0, frequency_penalty=0.0):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.frequency_penalty = frequency_penalty
+
+    @property
+    def has_penalties(self):
+        return self.repetition_penalty != 1.0 or self.frequency_penalty != 0.0
+
+
+class TokenCounts:
+    """
+    How often each token occurs in the output of every slot of the batch,
+    and which tokens occur in its prompt. Updated one token at a time rather
+    than recounted from the sequences at every step.
+    """
+
+    def __init__(self, max_batch_size, vocab_size):
+        self.counts = torch.zeros(max_batch_size, vocab_size)
+        self.in_prompt = torch.zeros(max_batch_size, vocab_size, dtype=torch.bool)
+
+    def reset(self, slot, prompt_ids):
+        self.counts[slot] = 0
+        self.in_prompt[slot] = False
+        self.in_prompt[slot, torch.as_tensor(prompt_ids, dtype=torch.long)] = True
+
+    def add(self, slot, token):
+        self.counts[slot, token] += 1
+
+    def move(self, src, dst):
+        self.counts[dst] = self.counts[src]
+        self.in_prompt[dst] = self.in_prompt[src]
+
+
+class SamplingBatch:
+    """The sampling controls of a batch of requests as per-row tensors."""
+
+    def __init__(self, params, counts=None, in_prompt=None):
+        self.temperature = torch.tensor([p.temperature for p in params])
+        self.top_k = torch.tensor([p.top_k for p in params], dtype=torch.long)
+        self.top_p = torch.tensor([p.top_p for p in params])
+        self.min_p = torch.tensor([p.min_p for p in params])
+        self.repetition_penalty = torch.tensor([p.repetition_penalty for p in params])
+        self.frequency_penalty = torch.tensor([p.frequency_penalty for p in params])
+        self.greedy = self.temperature < 1e-4
+        # The token counts of the rows, only kept if some row has penalties.
+        self.counts = self.in_prompt = None
+        if counts is not None and any(p.has_penalties for p in params):
+            self.counts, self.in_prompt = counts, in_prompt
+
+    def expand(self, draft_tokens):
+        """
+        The batch for verifying `draft_tokens` [rows, k]: every row repeated
+        for its k + 1 positions, with the counts of position j including the
+        first j proposals.
+        """
+        n, k = draft_tokens.shape
+        expanded = SamplingBatch([])
+        for name in ["temperature", "top_k", "top_p", "min_p", "repetition_penalty",
+                     "frequency_penalty", "greedy"]:
+            setattr(expanded, name, getattr(self, name).repeat_interleave(k + 1))
+        if self.counts is not None:
+            counts = self.counts.unsqueeze(1).repeat(1, k + 1, 1)
+            drafted = torch.zeros_like(counts[:, 1:]).scatter_(-1, draft_tokens.unsqueeze(-1), 1.0)
+            counts[:, 1:] += drafted.cumsum(dim=1)
+            expanded.counts = counts.view(n * (k + 1), -1)
+            expanded.in_prompt = self.in_prompt.repeat_interleave(k + 1, dim=0)
+        return expanded
+
+
+def apply_penalties(logits, batch):
+    if batch.counts is None:
+        return logits
+    penalty = batch.repetition_penalty.unsqueeze(-1)
+    if (penalty != 1.0).any():
+        seen = (batch.counts > 0) | batch.in_prompt
+        penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+        logits = torch.where(seen, penalized, logits)
+    if (batch.frequency_penalty != 0.0).any():
+        logits = logits - batch.frequency_penalty.unsqueeze(-1) * batch.counts
+    return logits
+
+
+def apply_temperature(logits, batch):
+    temperature = torch.where(batch.greedy, 1.0, batch.temperature)
+    if (temperature == 1.0).all():
+        return logits
+    return logits / temperature.unsqueeze(-1)
+
+
+def apply_top_k_top_p(logits, batch):
+    vocab_size = logits.shape[-1]
+    top_k = torch.where(batch.top_k > 0, batch.top_k, vocab_size).clamp(max=vocab_size)
+    active = (top_k < vocab_size) | (batch.top_p < 1.0)
+    if not active.any():
+        return logits
+
+    # Only the top-k candidates are sorted for top-p, so a row that sets
+    # both never sorts the whole vocabulary.
+    k = int(top_k[active].max())
+    values, indices = torch.topk(logits, k, dim=-1)
+    keep = torch.arange(k) < top_k.unsqueeze(-1)
+    if (batch.top_p < 1.0).any():
+        probs = torch.softmax(values.masked_fill(~keep, -float("inf")), dim=-1)
+        # Keep the smallest prefix whose probability reaches top_p.
+        keep &= probs.cumsum(dim=-1) - probs < batch.top_p.unsqueeze(-1)
+        keep[:, 0] = True
+    values = values.masked_fill(~keep, -float("inf"))
+    filtered = torch.full_like(logits, -float("inf")).scatter_(-1, indices, values)
+    return torch.where(active.unsqueeze(-1), filtered, logits)
+
+
+def apply_min_p(logits, batch):
+    if not (batch.min_p > 0).any():
+        return logits
+    probs = torch.softmax(logits, dim=-1)
+    threshold = probs.max(dim=-1, keepdim=True).values * batch.min_p.unsqueeze(-1)
+    return logits.masked_fill(probs < threshold, -float("inf"))
+
+
+# Applied in order to the logits [rows, vocab] of a batch; every processor
+# is a no-op unless some row of the batch uses it.
+LOGITS_PROCESSORS = [apply_penalties, apply_temperature, apply_top_k_top_p, apply_min_p]
+
+
+def process_logits(logits, batch):
+    logits = logits.float()
+    for processor in LOGITS_PROCESSORS:
+        logits = processor(logits, batch)
+    return logits
+
+
+def token_probs(logits, batch):
+    """
+    The sampling distribution of every row of `logits` [rows, vocab].
+    Greedy rows become one-hot, which lets rejection sampling handle greedy
+    and sampled requests alike.
+    """
+    logits = process_logits(logits, batch)
+    probs = torch.softmax(logits, dim=-1)
+    one_hot = torch.zeros_like(probs).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+    return torch.where(batch.greedy.unsqueeze(-1), one_hot, probs)
+
+
+def sample_tokens(logits, batch):
+    """Sample one token per row of `logits` [rows, vocab]."""
+    logits = process_logits(logits, batch)
+    tokens = torch.argmax(logits, dim=-1)
+    do_sample = ~batch.greedy
+    if do_sample.any():
+        probs = torch.softmax(logits[do_sample], dim=-1)
+        tokens[do_sample] = torch.multinomial(probs, num_samples=1).squeeze(-1)
+    return tokens.tolist()
@@ -0,0 +1,421 @@
+"""
+An iteration-level scheduler that runs the decode steps of all active
+requests of a model worker as one batched forward pass.
+"""
+import asyncio
+import collections
+import threading
+import time
+
+import torch
+
+from fastchat.serve.kv_cache import StaticKVCache, patch_static_attention
+from fastchat.serve.sampling import SamplingBatch, TokenCounts, sample_tokens, token_probs
+from fastchat.serve.speculative import verify
+
+
+class GenerationRequest:
+    """
+    The state of one generation request inside the scheduler. Must be
+    created on the event loop that consumes its output.
+    """
+
+    def __init__(self, input_ids, sampling_params, max_new_tokens,
+                 detokenizer, stop_matcher, stop_token_ids=(), score_prompt=False):
+        self.input_ids = input_ids
+        self.sampling_params = sampling_params
+        self.max_new_tokens = max_new_tokens
+        self.detokenizer = detokenizer
+        self.stop_matcher = stop_matcher
+        self.stop_token_ids = set(stop_token_ids)
+        self.output_ids = []
+        self.num_cached_tokens = 0
+        self.num_prefilled = 0
+        # With `score_prompt`, the log-probability of every prompt token
+        # after the first; this needs the logits of all prompt positions.
+        self.score_prompt = score_prompt
+        self.prompt_logprobs = []
+
+        # The text of every sampled token is pushed here (possibly "" while
+        # a character is incomplete or may start a stop string), followed by
+        # None when the request finishes or by an exception when the model
+        # fails.
+        self.loop = asyncio.get_running_loop()
+        self.output_queue = asyncio.Queue()
+        self.aborted = False
+
+    def put(self, item):
+        """Hand `item` to the event loop; called from the scheduler thread."""
+        self.loop.call_soon_threadsafe(self.output_queue.put_nowait, item)
+
+    def abort(self):
+        """Ask the scheduler to drop this request before its next step."""
+        self.aborted = True
+
+    def append_token(self, token, eos_token_id):
+        """Record a sampled token. Return its text and whether `self` is done."""
+        self.output_ids.append(token)
+        if token in self.stop_token_ids:
+            # The stop token itself is not shown, but the text held back
+            # before it is.
+            return self.finish(), True
+        text, stopped = self.stop_matcher.feed(self.detokenizer.push(token))
+        if stopped:
+            return text, True
+
+        if (self.aborted or token == eos_token_id or
+                len(self.output_ids) >= self.max_new_tokens):
+            return text + self.finish(), True
+        return text, False
+
+    def finish(self):
+        text, stopped = self.stop_matcher.feed(self.detokenizer.flush())
+        if not stopped:
+            text += self.stop_matcher.flush()
+        return text
+
+
+class BatchScheduler:
+    """
+    Continuous batching over OPT with a preallocated StaticKVCache.
+
+    Running requests occupy the cache slots [0, len(running)) in order; a
+    new request is prefilled straight into the next free slot and joins the
+    batch, and when a request leaves, the last one is moved into its slot so
+    that every decode step runs on one contiguous block of rows.
+
+    With a PrefixCache, a new request starts from the longest cached prefix
+    of its prompt and the states of every request that leaves are cached.
+
+    Prompts are prefilled in chunks of at most `prefill_chunk_size` tokens
+    (0 means the whole prompt at once), one chunk between two decode steps.
+    The request being prefilled owns the slot right after the running ones.
+
+    With a `proposer` (see fastchat.serve.speculative), every decode step
+    verifies `proposer.num_tokens` proposed tokens per request in a single
+    forward pass and emits the accepted ones plus one token of its own.
+    """
+
+    def __init__(self, model, eos_token_id, max_batch_size, context_len,
+                 prefix_cache=None, prefill_chunk_size=0, proposer=None):
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.prefill_chunk_size = prefill_chunk_size
+        self.proposer = proposer
+
+        self.num_verify_rows = 0
+        self.num_proposed_tokens = 0
+        self.num_accepted_tokens = 0
+        self.propose_time = 0.0
+        self.verify_time = 0.0
+
+        # (time, number of tokens generated) of the steps in the last
+        # `rate_window` seconds.
+        self.rate_window = 10.0
+        self.step_log = collections.deque()
+        self.step_tokens = 0
+
+        patch_static_attention(model)
+        self.cache = StaticKVCache.for_model(model, max_batch_size, context_len)
+        self.token_counts = TokenCounts(max_batch_size, model.config.vocab_size)
+
+        self.waiting = collections.deque()
+        self.running = []
+        self.prefilling = None
+
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        with self.cond:
+            self.waiting.append(request)
+            self.cond.notify()
+
+    def stop(self):
+        """Let the thread exit as soon as there is no work left."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while not self.waiting and not self.running and self.prefilling is None:
+                    if self.stopped:
+                        return
+                    self.cond.wait()
+            try:
+                self.step()
+            except Exception as e:
+                self.fail_all(e)
+
+    def fail_all(self, error):
+        with self.cond:
+            requests = self.running + list(self.waiting)
+            self.waiting.clear()
+        if self.prefilling is not None:
+            requests.append(self.prefilling)
+        for req in requests:
+            req.put(error)
+        self.running = []
+        self.prefilling = None
+
+    @torch.inference_mode()
+    def step(self):
+        aborted = [req for req in self.running if req.aborted]
+        for req in aborted:
+            req.put(None)
+        self.evict(aborted)
+        if self.prefilling is not None and self.prefilling.aborted:
+            self.prefilling.put(None)
+            self.prefilling = None
+
+        while self.prefilling is None and len(self.running) < self.max_batch_size:
+            with self.cond:
+                if not self.waiting:
+                    break
+                req = self.waiting.popleft()
+            if req.aborted:
+                req.put(None)
+                continue
+            try:
+                self.start_prefill(req)
+            except Exception as e:
+                self.fail_prefill(e)
+
+        # At most one prefill chunk runs between two decode steps, which
+        # bounds the stall a long prompt causes to the running requests.
+        if self.prefilling is not None:
+            self.prefill()
+        if self.running:
+            self.decode()
+        self.log_step()
+
+    def log_step(self):
+        now = time.time()
+        if self.step_tokens:
+            self.step_log.append((now, self.step_tokens))
+            self.step_tokens = 0
+        while self.step_log and self.step_log[0][0] < now - self.rate_window:
+            self.step_log.popleft()
+
+    def cache_bytes(self):
+        """The memory budget of the KV caches, prefix cache and draft cache."""
+        num_bytes = self.cache.num_bytes
+        if self.prefix_cache is not None:
+            num_bytes += self.prefix_cache.max_bytes
+        if getattr(self.proposer, "cache", None) is not None:
+            num_bytes += self.proposer.cache.num_bytes
+        return num_bytes
+
+    def load(self):
+        """
+        A snapshot of the work in the scheduler: the requests in the batch
+        (including the one being prefilled) and in the queue, the tokens
+        still to be prefilled or generated for them (counting max_new_tokens
+        as the estimate of every output), and the recent generation rate.
+        """
+        with self.cond:
+            waiting = list(self.waiting)
+        running = list(self.running)
+        prefilling = self.prefilling
+        pending_tokens = sum(req.max_new_tokens - len(req.output_ids) for req in running)
+        pending_tokens += sum(len(req.input_ids) + req.max_new_tokens for req in waiting)
+        if prefilling is not None:
+            running.append(prefilling)
+            pending_tokens += (len(prefilling.input_ids) - prefilling.num_prefilled +
+                               prefilling.max_new_tokens)
+
+        log = list(self.step_log)
+        elapsed = time.time() - log[0][0] if log else 0
+        return {
+            "num_running": len(running),
+            "num_waiting": len(waiting),
+            "pending_tokens": pending_tokens,
+            "decode_tokens_per_s": sum(n for _, n in log) / max(elapsed, 1.0),
+        }
+
+    def forward(self, input_ids, start, end, num_logits=None):
+        return self.cache.run(self.model, input_ids, start, end, num_logits)
+
+    def sampling_batch(self, requests, start):
+        end = start + len(requests)
+        return SamplingBatch([req.sampling_params for req in requests],
+                             self.token_counts.counts[start:end],
+                             self.token_counts.in_prompt[start:end])
+
+    def start_prefill(self, req):
+        self.prefilling = req
+        slot = len(self.running)
+        if self.prefix_cache is not None and not req.score_prompt:
+            # At least one prompt token is run to get the next-token logits.
+            req.num_cached_tokens, segments = self.prefix_cache.match(req.input_ids[:-1])
+            self.cache.load(slot, segments)
+        else:
+            self.cache.reset(slot)
+        req.num_prefilled = req.num_cached_tokens
+        self.token_counts.reset(slot, req.input_ids)
+        if self.proposer is not None:
+            self.proposer.start(slot)
+
+    def fail_prefill(self, error):
+        """
+        End the request being prefilled with `error`. It is not in the batch
+        yet, so the running requests carry on.
+        """
+        self.prefilling.put(error)
+        self.prefilling = None
+
+    def prefill(self):
+        """Run the next chunk of the prompt of the request being prefilled."""
+        try:
+            self.prefill_chunk()
+        except Exception as e:
+            if self.prefilling is not None:
+                self.fail_prefill(e)
+
+    def prefill_chunk(self):
+        req = self.prefilling
+        slot = len(self.running)
+        end = len(req.input_ids)
+        if self.prefill_chunk_size > 0:
+            end = min(end, req.num_prefilled + self.prefill_chunk_size)
+        input_ids = req.input_ids[req.num_prefilled:end]
+        # Only the last position of the prompt is needed for sampling.
+        num_logits = 1 if end == len(req.input_ids) else 0
+        if req.score_prompt:
+            num_logits = None
+        logits = self.forward(torch.as_tensor([input_ids]), slot, slot + 1, num_logits)
+        if self.proposer is not None:
+            self.proposer.prefill(req.input_ids[:end], slot)
+        if req.score_prompt:
+            targets = torch.as_tensor(req.input_ids[req.num_prefilled + 1:end + 1])
+            logprobs = torch.log_softmax(logits[0, :len(targets)].float(), dim=-1)
+            req.prompt_logprobs += logprobs.gather(-1, targets.unsqueeze(-1)).squeeze(-1).tolist()
+        req.num_prefilled = end
+        if end < len(req.input_ids):
+            return
+
+        token = sample_tokens(logits[:, -1], self.sampling_batch([req], slot))[0]
+        self.prefilling = None
+        if self.emit(req, token, slot):
+            self.save_prefix(req, slot)
+        else:
+            self.running.append(req)
+
+    @torch.inference_mode()
+    def pin_prefix(self, token_ids):
+        """
+        Prefill `token_ids` and pin their states in the prefix cache. Must be
+        called before any request is submitted.
+        """
+        assert not self.running and not self.waiting
+        self.cache.reset(0)
+        self.forward(torch.as_tensor([token_ids]), 0, 1, num_logits=0)
+        keys, values = self.cache.slot_states(0)
+        self.prefix_cache.insert(token_ids, keys, values, pinned=True)
+
+    def save_prefix(self, req, slot):
+        if self.prefix_cache is None:
+            return
+        keys, values = self.cache.slot_states(slot)
+        token_ids = (req.input_ids + req.output_ids)[:keys.shape[2]]
+        n = len(token_ids)
+        self.prefix_cache.insert(token_ids, keys[:, :, :n], values[:, :, :n])
+
+    def decode(self):
+        if self.proposer is not None:
+            self.speculative_decode()
+            return
+        input_ids = torch.as_tensor([[req.output_ids[-1]] for req in self.running])
+        logits = self.forward(input_ids, 0, len(self.running))
+
+        tokens = sample_tokens(logits[:, -1], self.sampling_batch(self.running, 0))
+        finished = [req for slot, (req, token) in enumerate(zip(self.running, tokens))
+                    if self.emit(req, token, slot)]
+        self.evict(finished)
+
+    def speculative_decode(self):
+        n = len(self.running)
+        batch = self.sampling_batch(self.running, 0)
+        last = torch.as_tensor([[req.output_ids[-1]] for req in self.running])
+        lengths = self.cache.lengths[:n].clone()
+
+        tic = time.perf_counter()
+        draft_tokens, draft_probs, num_proposed = self.proposer.propose(
+            self.running, batch)
+        toc = time.perf_counter()
+        logits = self.forward(torch.cat([last, draft_tokens], dim=1), 0, n)
+        target_probs = token_probs(logits.flatten(0, 1), batch.expand(draft_tokens))
+        outputs = verify(target_probs.view(n, -1, target_probs.shape[-1]),
+                         draft_tokens, draft_probs, num_proposed)
+        self.propose_time += toc - tic
+        self.verify_time += time.perf_counter() - toc
+
+        # Keep the last token and the accepted proposals; the token drawn
+        # from the target is run by the next step like a sampled one.
+        lengths += torch.tensor([len(tokens) for tokens in outputs])
+        self.cache.truncate(0, lengths)
+        self.proposer.truncate(0, lengths)
+
+        self.num_verify_rows += n
+        self.num_proposed_tokens += (int(num_proposed.sum()) if num_proposed is not None
+                                     else draft_tokens.numel())
+        self.num_accepted_tokens += sum(len(tokens) - 1 for tokens in outputs)
+
+        finished = []
+        for slot, (req, tokens) in enumerate(zip(self.running, outputs)):
+            for token in tokens:
+                if self.emit(req, token, slot):
+                    finished.append(req)
+                    break
+        self.evict(finished)
+
+    def speculative_stats(self):
+        """
+        Acceptance rate of the proposals, tokens emitted per request and
+        target forward pass, and the resulting speedup over plain decoding,
+        estimated by assuming that a verification pass costs as much as a
+        single-token decode step.
+        """
+        rows = max(self.num_verify_rows, 1)
+        tokens_per_step = 1 + self.num_accepted_tokens / rows
+        total_time = self.propose_time + self.verify_time
+        return {
+            "acceptance_rate": self.num_accepted_tokens / max(self.num_proposed_tokens, 1),
+            "tokens_per_step": tokens_per_step,
+            "speedup": tokens_per_step * self.verify_time / total_time if total_time else 1.0,
+        }
+
+    def emit(self, req, token, slot):
+        """Hand a sampled token to the consumer. Return True if `req` is done."""
+        text, finished = req.append_token(token, self.eos_token_id)
+        self.token_counts.add(slot, token)
+        self.step_tokens += 1
+        req.put(text)
+        if finished:
+            req.put(None)
+        return finished
+
+    def evict(self, requests):
+        for req in requests:
+            slot = self.running.index(req)
+            self.save_prefix(req, slot)
+            last = len(self.running) - 1
+            if slot != last:
+                self.move_slot(last, slot)
+                self.running[slot] = self.running[last]
+            self.running.pop()
+            if self.prefilling is not None:
+                # Keep the prompt being prefilled right after the running rows.
+                self.move_slot(last + 1, last)
+
+    def move_slot(self, src, dst):
+        self.cache.move(src, dst)
+        self.token_counts.move(src, dst)
+        if self.proposer is not None:
+            self.proposer.move(src, dst)
@@ -0,0 +1,65 @@
+"""
+Fan the output of one generation request out to several consumers.
+"""
+import asyncio
+
+
+class SharedStream:
+    """
+    The output of a GenerationRequest, shared by every consumer that
+    subscribes to it.
+
+    A subscriber gets a queue that starts with the text generated so far and
+    then receives the same items as the request's own output queue. The
+    request is aborted when its last subscriber leaves. `on_done` is called
+    once, when the stream finishes or is abandoned; `texts`, `final` (None
+    or the exception) and `req.aborted` tell which.
+    """
+
+    def __init__(self, req, on_done=None):
+        self.req = req
+        self.on_done = on_done
+        self.texts = []
+        self.final = None
+        self.finished = False
+        self.closed = False
+        self.subscribers = set()
+        self.task = asyncio.create_task(self.pump())
+
+    async def pump(self):
+        while True:
+            item = await self.req.output_queue.get()
+            if item is not None and not isinstance(item, Exception):
+                self.texts.append(item)
+            for queue in self.subscribers:
+                queue.put_nowait(item)
+            if item is None or isinstance(item, Exception):
+                break
+        self.final = item
+        self.finished = True
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.on_done is not None:
+                self.on_done(self)
+
+    def subscribe(self):
+        queue = asyncio.Queue()
+        for text in self.texts:
+            queue.put_nowait(text)
+        if self.finished:
+            queue.put_nowait(self.final)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        """Drop a subscriber; its queue ends with None."""
+        if queue not in self.subscribers:
+            return
+        self.subscribers.discard(queue)
+        queue.put_nowait(None)
+        if not self.subscribers and not self.finished:
+            self.req.abort()
+            self.close()
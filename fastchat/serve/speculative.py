@@ -0,0 +1,182 @@
+"""
+Speculative decoding: verify several proposed tokens with one forward pass
+of the target model.
+"""
+import weakref
+
+import torch
+
+from fastchat.serve.kv_cache import StaticKVCache, patch_static_attention
+from fastchat.serve.sampling import token_probs
+
+
+def verify(target_probs, draft_tokens, draft_probs=None, num_proposed=None):
+    """
+    Standard speculative rejection sampling.
+
+    target_probs: [batch, k + 1, vocab], the target distribution after the
+        last accepted token and after each proposed token.
+    draft_tokens: [batch, k], the proposed tokens.
+    draft_probs: [batch, k, vocab], the distributions they were drawn from,
+        or None if the proposals are deterministic.
+    num_proposed: optional [batch], how many of the k proposals are real.
+
+    Return for every row the accepted proposals followed by one token drawn
+    from the target distribution, so the output is distributed exactly as
+    if the target had sampled every token itself.
+    """
+    batch, k = draft_tokens.shape
+    index = draft_tokens.unsqueeze(-1)
+    p = target_probs[:, :k].gather(-1, index).squeeze(-1)
+    if draft_probs is None:
+        accept = torch.rand_like(p) < p
+    else:
+        q = draft_probs.gather(-1, index).squeeze(-1)
+        accept = torch.rand_like(p) * q < p
+    if num_proposed is not None:
+        accept &= torch.arange(k) < num_proposed.unsqueeze(-1)
+    # The number of proposals accepted before the first rejection.
+    num_accepted = torch.cumprod(accept.int(), dim=-1).sum(dim=-1).tolist()
+
+    outputs = []
+    for i, a in enumerate(num_accepted):
+        probs = target_probs[i, a]
+        if a < k and (num_proposed is None or a < num_proposed[i]):
+            if draft_probs is None:
+                residual = probs.clone()
+                residual[draft_tokens[i, a]] = 0
+            else:
+                residual = (probs - draft_probs[i, a]).clamp(min=0)
+            if residual.sum() > 0:
+                probs = residual
+        token = int(torch.multinomial(probs, num_samples=1))
+        outputs.append(draft_tokens[i, :a].tolist() + [token])
+    return outputs
+
+
+class DraftModelProposer:
+    """
+    Propose tokens by sampling them from a small draft model that shares
+    the tokenizer of the target, e.g. opt-125m for opt-1.3b.
+
+    The draft keeps its own StaticKVCache with the same slot layout as the
+    scheduler's, so slots are reset, moved and truncated in lockstep.
+    """
+
+    def __init__(self, model, num_tokens, max_batch_size, context_len):
+        self.model = model
+        self.num_tokens = num_tokens
+        patch_static_attention(model)
+        self.cache = StaticKVCache.for_model(model, max_batch_size, context_len)
+
+    def start(self, slot):
+        self.cache.reset(slot)
+
+    def prefill(self, input_ids, slot):
+        """Catch up with the target, which has run `input_ids` in `slot`."""
+        pos = int(self.cache.lengths[slot])
+        self.cache.run(self.model, torch.as_tensor([input_ids[pos:]]), slot, slot + 1,
+                       num_logits=0)
+
+    def move(self, src, dst):
+        self.cache.move(src, dst)
+
+    def truncate(self, start, lengths):
+        self.cache.truncate(start, lengths)
+
+    def propose(self, requests, batch):
+        """
+        Return `num_tokens` proposals [batch, k], the distributions they were
+        sampled from [batch, k, vocab], and None since every row gets k.
+        """
+        n = len(requests)
+        input_ids = torch.as_tensor([[req.output_ids[-1]] for req in requests])
+        tokens, probs = [], []
+        for i in range(self.num_tokens + 1):
+            if i == self.num_tokens:
+                # The last proposal is run as well, so that the cache holds
+                # every token the target may accept.
+                self.cache.run(self.model, input_ids, 0, n, num_logits=0)
+                break
+            logits = self.cache.run(self.model, input_ids, 0, n)
+            p = token_probs(logits[:, -1], batch)
+            input_ids = torch.multinomial(p, num_samples=1)
+            tokens.append(input_ids)
+            probs.append(p)
+        return torch.cat(tokens, dim=1), torch.stack(probs, dim=1), None
+
+
+class _NgramIndex:
+    def __init__(self, tokens, max_ngram):
+        self.tokens = list(tokens)
+        self.num_prompt_tokens = len(self.tokens)
+        self.max_ngram = max_ngram
+        # For n = 1..max_ngram, the position right after the latest
+        # occurrence of each n-gram, not counting the one at the very end.
+        self.latest = [None] + [{} for _ in range(max_ngram)]
+        self.num_indexed = 0
+
+    def extend(self, output_ids):
+        self.tokens.extend(output_ids[len(self.tokens) - self.num_prompt_tokens:])
+        for end in range(self.num_indexed + 1, len(self.tokens)):
+            for n in range(1, min(self.max_ngram, end) + 1):
+                self.latest[n][tuple(self.tokens[end - n:end])] = end
+        self.num_indexed = max(len(self.tokens) - 1, 0)
+
+    def lookup(self, num_tokens):
+        """The tokens that followed the latest earlier occurrence of the
+        longest possible suffix."""
+        for n in range(min(self.max_ngram, len(self.tokens)), 0, -1):
+            end = self.latest[n].get(tuple(self.tokens[-n:]))
+            if end is not None:
+                return self.tokens[end:end + num_tokens]
+        return []
+
+
+class NgramProposer:
+    """
+    Prompt lookup: propose the tokens that followed the latest earlier
+    occurrence of the last (up to `max_ngram`) tokens of the prompt plus
+    output. Summaries and code edits copy long spans from their prompts,
+    and this costs no model at all.
+
+    Every request gets an n-gram index that is extended with the new output
+    tokens at each step.
+    """
+
+    def __init__(self, max_ngram, num_tokens):
+        self.max_ngram = max_ngram
+        self.num_tokens = num_tokens
+        self.indexes = weakref.WeakKeyDictionary()
+
+    def start(self, slot):
+        pass
+
+    def prefill(self, input_ids, slot):
+        pass
+
+    def move(self, src, dst):
+        pass
+
+    def truncate(self, start, lengths):
+        pass
+
+    def propose(self, requests, batch):
+        """
+        Return the proposals [batch, k] padded to the longest one, None as
+        they are deterministic, and the number of real proposals of every
+        row.
+        """
+        proposals = []
+        for req in requests:
+            index = self.indexes.get(req)
+            if index is None:
+                index = self.indexes[req] = _NgramIndex(req.input_ids, self.max_ngram)
+            index.extend(req.output_ids)
+            proposals.append(index.lookup(self.num_tokens))
+
+        k = max(len(tokens) for tokens in proposals)
+        tokens = torch.zeros(len(requests), k, dtype=torch.long)
+        for i, proposal in enumerate(proposals):
+            tokens[i, :len(proposal)] = torch.tensor(proposal, dtype=torch.long)
+        return tokens, None, torch.tensor([len(proposal) for proposal in proposals])
@@ -0,0 +1,78 @@
+"""
+Streaming stop-sequence matching for generation.
+"""
+import collections
+
+
+class StopMatcher:
+    """
+    Find the first occurrence of any stop string in a stream of text deltas.
+
+    The stop strings are compiled into an Aho-Corasick automaton, so each fed
+    character costs amortized O(1) no matter how many stop strings there are
+    or how long the output gets. Text that may be the beginning of a stop
+    string is held back until it either completes a match (and is dropped) or
+    can no longer match (and is released).
+    """
+
+    def __init__(self, stop_strs=()):
+        stop_strs = [s for s in stop_strs if s]
+        self.goto = [{}]
+        self.fail = [0]
+        # Length of the longest stop string that ends at each state.
+        self.match_len = [0]
+        self.depth = [0]
+
+        for s in stop_strs:
+            state = 0
+            for ch in s:
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.match_len.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.match_len[state] = max(self.match_len[state], len(s))
+
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                self.match_len[nxt] = max(self.match_len[nxt], self.match_len[self.fail[nxt]])
+
+        self.state = 0
+        self.held = ""
+
+    def feed(self, text):
+        """
+        Consume a text delta. Return the text that is safe to emit and
+        whether a stop string was matched (the match itself is never emitted).
+        """
+        buf = self.held + text
+        state = self.state
+        for i in range(len(self.held), len(buf)):
+            ch = buf[i]
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            if self.match_len[state]:
+                self.state = 0
+                self.held = ""
+                return buf[:i + 1 - self.match_len[state]], True
+
+        self.state = state
+        keep = self.depth[state]
+        self.held = buf[len(buf) - keep:] if keep else ""
+        return buf[:len(buf) - keep], False
+
+    def flush(self):
+        """Release the held-back text at the end of the stream."""
+        text, self.held, self.state = self.held, "", 0
+        return text
@@ -36,6 +36,7 @@ def main():
         "max_new_tokens": args.max_new_tokens,
         "temperature": 0.7,
         "stop": conv.sep,
+        "delta": args.delta,
     }
     response = requests.post(worker_addr + "/worker_generate_stream", headers=headers,
             json=pload, stream=True)
@@ -44,8 +45,11 @@ def main():
     for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0"):
         if chunk:
             data = json.loads(chunk.decode("utf-8"))
-            output = data["text"].split(conv.sep)[-1]
-            print(output, end="\r")
+            if args.delta:
+                print(data["text"], end="", flush=True)
+            else:
+                output = data["text"].split(conv.sep)[-1]
+                print(output, end="\r")
     print("")
 
 
@@ -57,6 +61,7 @@ if __name__ == "__main__":
     parser.add_argument("--max-new-tokens", type=int, default=32)
     parser.add_argument("--message", type=str, default=
         "Tell me a story with more than 1000 words.")
+    parser.add_argument("--delta", action="store_true")
     args = parser.parse_args()
 
     main()